@@ -0,0 +1,45 @@
+"""This module computes the figures shown on the Insights page. All of them
+are read from the ledger and rollup tables that `user` keeps current, in one
+unit of work, so a page load costs one snapshot of the user's database whose
+size depends on the number of distinct days, months and categories, not on
+the number of transactions.
+"""
+
+from user import unit_of_work
+
+
+def get_insights(username):
+    """
+    Returns the aggregates behind the Insights page of a user as a JSON-serializable
+    dictionary, so it can be kept in a `dcc.Store` and shared by the page's callbacks.
+
+    :param username: The username of the user.
+    :return: Dictionary with keys 'total_income' and 'total_expenses'; 'categories',
+        a list of {'category', 'amount'} sorted by amount, largest first; 'daily_expenses',
+        a list of {'date', 'amount'}; and 'monthly_income', a list of {'month', 'amount'}
+        with months in 'YYYY-MM' format. Series are sorted by date.
+    """
+    with unit_of_work(username) as conn:
+        c = conn.cursor()
+
+        # Running totals kept by the ledger triggers
+        c.execute("SELECT income, expenses FROM ledger WHERE id = 1")
+        total_income, total_expenses = c.fetchone()
+
+        c.execute("""SELECT category, SUM(total) AS amount FROM expense_rollup
+                     GROUP BY category ORDER BY amount DESC""")
+        categories = [{"category": category, "amount": amount} for category, amount in c.fetchall()]
+
+        c.execute("SELECT day, total FROM expense_daily ORDER BY day")
+        daily_expenses = [{"date": day, "amount": amount} for day, amount in c.fetchall()]
+
+        c.execute("SELECT month, total FROM income_monthly ORDER BY month")
+        monthly_income = [{"month": month, "amount": amount} for month, amount in c.fetchall()]
+
+    return {
+        "total_income": total_income,
+        "total_expenses": total_expenses,
+        "categories": categories,
+        "daily_expenses": daily_expenses,
+        "monthly_income": monthly_income,
+    }
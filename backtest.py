@@ -0,0 +1,355 @@
+"""This module evaluates GARCH volatility forecasts out of sample. A
+training window is rolled across a ticker's history, the model is refit
+every few days and each day's variance is forecast from the data before it.
+Forecasts are stored in a small SQLite database next to the models, so
+re-running a backtest only computes the windows added since the last run.
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from arch import arch_model
+from arch.utility.exceptions import StartingValueWarning
+
+BACKTEST_FILENAME = "backtests.db"
+
+# Monday from which refit blocks are counted, in business days
+BLOCK_EPOCH = "1970-01-05"
+
+# Fewest returns a backtest model may be fit on
+MIN_WINDOW = 100
+
+
+def check_settings(window, refit_every, p, q):
+    """Raise `ValueError` with a message naming the first invalid backtest
+    setting, see `run_backtest`."""
+    if p < 1 or q < 1:
+        raise ValueError("`p` and `q` must be at least 1.")
+    if refit_every < 1:
+        raise ValueError("`refit_every` must be at least 1.")
+    if window < MIN_WINDOW:
+        raise ValueError(f"`window` must be at least {MIN_WINDOW} returns.")
+
+
+def block_starts(dates, window, refit_every):
+    """Return index of the first forecast day of each refit block.
+
+    Blocks are anchored to a fixed calendar rather than to the start of the
+    history: block `k` holds the days whose business-day count since
+    `BLOCK_EPOCH` is in `[k * refit_every, (k + 1) * refit_every)`. A block
+    therefore covers the same days, and is forecast by the model fit on the
+    same `window` returns before it, however far back the history goes.
+    Blocks with fewer than `window` returns before them are left out.
+
+    Parameters
+    ----------
+    dates : pd.DatetimeIndex
+        Dates of the returns, oldest first.
+    window : int
+    refit_every : int
+
+    Returns
+    -------
+    list
+    """
+    days = np.busday_count(BLOCK_EPOCH, np.asarray(dates, dtype="datetime64[D]"))
+    blocks = days // refit_every
+    starts = np.flatnonzero(np.diff(blocks, prepend=blocks[0] - 1))
+    return [int(start) for start in starts if start >= window]
+
+
+def forecast_block(params, resid, variance, returns, p, q):
+    """Forecast one-day-ahead variance through `returns` with fixed
+    parameters.
+
+    Parameters
+    ----------
+    params : np.ndarray
+        Values of 'mu', 'omega', 'alpha[1]'..., and 'beta[1]'....
+    resid : np.ndarray
+        Last `p` residuals of the training window, oldest first.
+    variance : np.ndarray
+        Last `q` conditional variances of the training window, oldest first.
+    returns : np.ndarray
+        Returns of the forecast days.
+    p : int
+    q : int
+
+    Returns
+    -------
+    np.ndarray
+        Variance forecast for each day of `returns`, made the day before.
+    """
+    mu, omega = params[0], params[1]
+    # Flip coefficients so that they line up with oldest-first history
+    alpha, beta = params[2:2 + p][::-1], params[2 + p:2 + p + q][::-1]
+    resid2, variance = list(np.asarray(resid) ** 2), list(variance)
+
+    forecasts = np.empty(len(returns))
+    for i, r in enumerate(returns):
+        forecasts[i] = omega + alpha @ resid2[-p:] + beta @ variance[-q:]
+        # Observe the day, roll history forward
+        resid2.append((r - mu) ** 2)
+        variance.append(forecasts[i])
+
+    return forecasts
+
+
+def fit_blocks(returns_path, blocks, window, p, q):
+    """Fit and forecast consecutive refit blocks.
+
+    Runs in a worker process of `run_backtest`. Each fit after the first is
+    started from the parameters of the previous block.
+
+    Parameters
+    ----------
+    returns_path : str
+        Path of `.npy` file with the returns, memory-mapped read-only.
+    blocks : list
+        `(start, stop)` index range of the forecast days of each block, see
+        `block_starts`.
+    window : int
+    p : int
+    q : int
+
+    Returns
+    -------
+    list
+        One dictionary per block, keys are 'start', 'forecasts',
+        'iterations', and 'fit_seconds'.
+    """
+    returns = np.load(returns_path, mmap_mode="r")
+    results, params = [], None
+    for start, stop in blocks:
+        checkpoint = time.perf_counter()
+        with warnings.catch_warnings():
+            # Previous parameters may not be valid starting values, `arch`
+            # then starts from its defaults
+            warnings.simplefilter("ignore", StartingValueWarning)
+            fitted = arch_model(
+                np.asarray(returns[start - window:start]), p=p, q=q, rescale=False
+            ).fit(disp=0, starting_values=params)
+        params = fitted.params.to_numpy()
+        fit_seconds = time.perf_counter() - checkpoint
+
+        forecasts = forecast_block(
+            params=params,
+            resid=np.asarray(fitted.resid)[window - p:],
+            variance=np.asarray(fitted.conditional_volatility)[window - q:] ** 2,
+            returns=returns[start:stop],
+            p=p,
+            q=q,
+        )
+        results.append({
+            "start": start,
+            "forecasts": forecasts.tolist(),
+            "iterations": int(fitted.optimization_result.nit),
+            "fit_seconds": fit_seconds,
+        })
+
+    return results
+
+
+def score(forecast, realized):
+    """Score variance forecasts against squared returns.
+
+    Parameters
+    ----------
+    forecast : np.ndarray
+        Forecast variance of each day.
+    realized : np.ndarray
+        Return of each day.
+
+    Returns
+    -------
+    dict
+        'n_forecasts'; 'mse', the mean squared error of the variance;
+        'qlike', the QLIKE loss; and 'mae', the mean absolute error of the
+        volatility against absolute returns. Lower is better.
+    """
+    realized2 = np.asarray(realized) ** 2
+    forecast = np.asarray(forecast)
+    return {
+        "n_forecasts": int(len(forecast)),
+        "mse": float(np.mean((realized2 - forecast) ** 2)),
+        "qlike": float(np.mean(np.log(forecast) + realized2 / forecast)),
+        "mae": float(np.mean(np.abs(np.sqrt(forecast) - np.sqrt(realized2)))),
+    }
+
+
+class BacktestStore:
+    """Cache of backtest forecasts, one row per backtest and day.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the database is created.
+    """
+
+    def __init__(self, directory):
+        self.__lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(directory, BACKTEST_FILENAME),
+            check_same_thread=False,
+            timeout=30,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS forecasts (
+                    backtest TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    variance REAL NOT NULL,
+                    PRIMARY KEY (backtest, date)
+                ) WITHOUT ROWID
+                """
+            )
+
+    def read(self, backtest):
+        """Return stored forecasts of `backtest` as a Series indexed by
+        ISO 8601 date."""
+        with self.__lock:
+            rows = self.connection.execute(
+                "SELECT date, variance FROM forecasts WHERE backtest = ?",
+                (backtest,),
+            ).fetchall()
+
+        return pd.Series(dict(rows), dtype=float)
+
+    def write(self, backtest, forecasts):
+        """Store `forecasts`, a Series of variances indexed by ISO 8601
+        date, replacing stored values for the same days."""
+        rows = zip([backtest] * len(forecasts), forecasts.index, forecasts.tolist())
+        with self.__lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO forecasts (backtest, date, variance) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+
+
+def run_backtest(
+    ticker,
+    returns,
+    window=500,
+    refit_every=20,
+    p=1,
+    q=1,
+    store=None,
+    executor=None,
+    chunks=None,
+):
+    """Backtest one-day-ahead GARCH(`p`, `q`) volatility forecasts.
+
+    Refit blocks are split into `chunks` runs of consecutive blocks that are
+    fit in parallel on `executor`, warm-starting within each run. The
+    returns are written once to a temporary `.npy` file that the workers
+    memory-map. Blocks whose forecasts are all in `store` are not
+    recomputed.
+
+    Parameters
+    ----------
+    ticker : str
+    returns : pd.Series
+        Daily returns in percent, oldest first, indexed by date.
+    window : int, optional
+        Number of returns each model is fit on. By default, 500.
+    refit_every : int, optional
+        Number of business days between refits, see `block_starts`. By
+        default, 20.
+    p : int, optional
+    q : int, optional
+    store : BacktestStore, None, optional
+        Cache of forecasts. If `None`, everything is computed. By default,
+        `None`.
+    executor : concurrent.futures.Executor, None, optional
+        Executor that fits the blocks. If `None`, they are fit in this
+        process. By default, `None`.
+    chunks : int, None, optional
+        Number of runs of blocks submitted to `executor`. If `None`, one per
+        CPU core. By default, `None`.
+
+    Returns
+    -------
+    dict
+        'forecast', a DataFrame indexed by date from the first refit block
+        on, with the forecast 'volatility' and the 'realized' absolute
+        return; 'metrics', see
+        `score`; 'blocks_computed'; and 'fit_seconds' of the computed blocks.
+    """
+    check_settings(window, refit_every, p, q)
+    if len(returns) <= window:
+        raise Exception(
+            f"Backtest needs more than {window} returns, got {len(returns)}."
+        )
+    dates = returns.index.strftime("%Y-%m-%d")
+    starts = block_starts(returns.index, window, refit_every)
+    if not starts:
+        raise Exception(
+            f"Backtest needs {window} returns before the first refit block."
+        )
+    # Blocks are anchored to the calendar, so forecasts of a day don't
+    # depend on where the history starts and are shared by all backtests
+    # with the same settings
+    backtest = f"{ticker}:{window}:{refit_every}:{p}:{q}"
+    first = starts[0]
+    blocks = list(zip(starts, starts[1:] + [len(returns)]))
+
+    cached = store.read(backtest) if store is not None else pd.Series(dtype=float)
+    is_cached = np.asarray(dates.isin(cached.index))
+    missing = [(start, stop) for start, stop in blocks if not is_cached[start:stop].all()]
+
+    fit_seconds = 0.0
+    if missing:
+        fd, returns_path = tempfile.mkstemp(suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, returns.to_numpy(dtype=np.float64))
+            args = (window, p, q)
+            if executor is None:
+                results = fit_blocks(returns_path, missing, *args)
+            else:
+                n_runs = min(chunks or os.cpu_count(), len(missing))
+                runs = np.array_split(np.arange(len(missing)), n_runs)
+                futures = [
+                    executor.submit(
+                        fit_blocks, returns_path, missing[run[0]:run[-1] + 1], *args
+                    )
+                    for run in runs
+                ]
+                results = [block for future in futures for block in future.result()]
+        finally:
+            os.remove(returns_path)
+
+        computed = pd.concat([
+            pd.Series(
+                block["forecasts"],
+                index=dates[block["start"]:block["start"] + len(block["forecasts"])],
+            )
+            for block in results
+        ])
+        fit_seconds = sum(block["fit_seconds"] for block in results)
+        if store is not None:
+            store.write(backtest, computed)
+        cached = computed.combine_first(cached)
+
+    variance = cached.reindex(dates[first:]).to_numpy()
+    realized = returns.to_numpy()[first:]
+    forecast = pd.DataFrame(
+        {"volatility": np.sqrt(variance), "realized": np.abs(realized)},
+        index=returns.index[first:],
+    )
+
+    return {
+        "forecast": forecast,
+        "metrics": score(variance, realized),
+        "blocks_computed": len(missing),
+        "fit_seconds": fit_seconds,
+    }
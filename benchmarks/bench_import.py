@@ -0,0 +1,106 @@
+"""Benchmark of `importer.import_statement` against adding the same rows
+one at a time with `user.add_income` and `user.add_expense`.
+
+Run from the repository root:
+
+    python benchmarks/bench_import.py [--rows 100000] [--baseline-rows 2000]
+
+A synthetic CSV statement is generated and imported into a throwaway user
+database in a temporary directory. The row-by-row baseline is timed on
+`--baseline-rows` rows and extrapolated.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import user  # noqa: E402
+from importer import import_statement  # noqa: E402
+
+DESCRIPTIONS = [
+    "CITY SUPERMARKET", "CORNER CAFE", "UBER TRIP", "MONTHLY RENT",
+    "ELECTRIC CO", "NETFLIX.COM", "PHARMACY 24", "HARDWARE STORE",
+]
+
+
+def make_statement(path, rows, seed=0):
+    """Write CSV statement with `rows` transactions, about one in ten a
+    credit, return the rows as `(date, amount, description)`."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end="2026-10-16", periods=rows, freq="5min").strftime("%m/%d/%Y")
+    amounts = np.round(rng.gamma(2.0, 20.0, rows), 2)
+    amounts[rng.random(rows) > 0.1] *= -1
+    descriptions = rng.choice(DESCRIPTIONS, rows)
+    transactions = list(zip(dates, amounts.tolist(), descriptions.tolist()))
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Date", "Amount", "Description"])
+        writer.writerows(transactions)
+    return transactions
+
+
+def add_row_by_row(username, transactions):
+    """Add transactions with the single-row functions of `user`, dates in
+    'YYYY-MM-DD' format."""
+    for date, amount, description in transactions:
+        if amount > 0:
+            user.add_income(username, amount, date)
+        else:
+            user.add_expense(username, -amount, description, date)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--baseline-rows", type=int, default=2000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        transactions = make_statement("statement.csv", args.rows)
+        size = os.path.getsize("statement.csv")
+        print(f"statement: {args.rows} rows, {size / 1e6:.1f} MB")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = import_statement("bulk", "statement.csv", chunk_size=args.chunk_size)
+            user.create_database("single")
+            baseline_rows = [
+                (pd.Timestamp(date).date().isoformat(), amount, description)
+                for date, amount, description in transactions[:args.baseline_rows]
+            ]
+            start = time.perf_counter()
+            add_row_by_row("single", baseline_rows)
+            baseline = (time.perf_counter() - start) / args.baseline_rows
+        user.connections.close()
+
+        # Aggregates after the import must match the raw tables
+        conn = sqlite3.connect("bulk.db")
+        ledger = conn.execute("SELECT income, expenses FROM ledger").fetchone()
+        totals = conn.execute(
+            "SELECT (SELECT SUM(amount) FROM income), (SELECT SUM(amount) FROM expenses)"
+        ).fetchone()
+        conn.close()
+        assert np.allclose(ledger, totals), (ledger, totals)
+        assert result["income"] + result["expenses"] == args.rows, result
+
+        bulk = result["seconds"]
+        print(f"{'import':>12}: {bulk:8.2f} s  {args.rows / bulk:10.0f} rows/s")
+        print(f"{'row by row':>12}: {baseline * args.rows:8.2f} s  {1 / baseline:10.0f} rows/s "
+              f"(extrapolated from {args.baseline_rows} rows)")
+        print(f"speedup: {baseline * args.rows / bulk:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Micro-benchmark of `data.parse_daily` against the parsing code that
+`AlphaVantageAPI.get_daily` used before, on a 20-year daily payload.
+
+Run from the repository root:
+
+    python benchmarks/bench_parse_daily.py [--payload recorded.json]
+
+Without `--payload`, a synthetic payload with the same layout as a
+`TIME_SERIES_DAILY_ADJUSTED` "full" response is generated.
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import orjson, parse_daily  # noqa: E402
+
+
+def make_payload(years=20, seed=0):
+    """Return bytes of a synthetic `TIME_SERIES_DAILY_ADJUSTED` response."""
+    dates = pd.bdate_range(end="2026-10-16", periods=years * 252)[::-1]
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(dates))))
+    series = {}
+    for date, price in zip(dates, close):
+        series[date.date().isoformat()] = {
+            "1. open": f"{price * 0.99:.4f}",
+            "2. high": f"{price * 1.01:.4f}",
+            "3. low": f"{price * 0.98:.4f}",
+            "4. close": f"{price:.4f}",
+            "5. adjusted close": f"{price:.4f}",
+            "6. volume": str(int(rng.integers(1e5, 1e7))),
+            "7. dividend amount": "0.0000",
+            "8. split coefficient": "1.0",
+        }
+    payload = {
+        "Meta Data": {"1. Information": "Daily Time Series with Splits and Dividend Events"},
+        "Time Series (Daily)": series,
+    }
+    return json.dumps(payload).encode()
+
+
+def legacy_parse(content):
+    """Parsing code of `AlphaVantageAPI.get_daily` before `parse_daily`."""
+    response_data = json.loads(content)
+    stock_data = response_data['Time Series (Daily)']
+    df = pd.DataFrame.from_dict(stock_data, orient="index", dtype=float)
+    df.index = pd.to_datetime(df.index)
+    df.index.name = "date"
+    df.columns = [c.split('. ')[1] for c in df.columns]
+    df.drop(columns=['dividend amount', 'split coefficient', 'volume'], inplace=True)
+    return df
+
+
+def scan_daily(content):
+    """`parse_daily` in low-memory mode."""
+    return parse_daily(content, low_memory=True)
+
+
+def measure(function, content, repeat):
+    """Return best time in seconds and peak traced allocation in bytes."""
+    seconds = min(timeit.repeat(lambda: function(content), number=1, repeat=repeat))
+    tracemalloc.start()
+    function(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--payload", help="Recorded AlphaVantage response")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.payload:
+        with open(args.payload, "rb") as f:
+            content = f.read()
+    else:
+        content = make_payload()
+
+    legacy = legacy_parse(content)
+    for function in (parse_daily, scan_daily):
+        pd.testing.assert_frame_equal(
+            legacy.sort_index(), function(content).sort_index(), check_freq=False,
+            check_index_type=False,
+        )
+
+    print(f"payload: {len(content) / 1e6:.1f} MB, {len(legacy)} days, "
+          f"orjson {'installed' if orjson else 'not installed'}")
+    results = {}
+    functions = [("legacy", legacy_parse), ("parse_daily", parse_daily), ("low_memory", scan_daily)]
+    for name, function in functions:
+        results[name] = measure(function, content, args.repeat)
+        seconds, peak = results[name]
+        print(f"{name:>12}: {seconds * 1e3:8.1f} ms  peak {peak / 1e6:6.1f} MB")
+
+    for name in ("parse_daily", "low_memory"):
+        speedup = results["legacy"][0] / results[name][0]
+        memory = results["legacy"][1] / results[name][1]
+        print(f"{name}: {speedup:.1f}x faster, {memory:.1f}x less memory allocated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""This module holds the in-memory caches used by the FastAPI service so
+that warm requests don't have to touch the filesystem.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ModelCache:
+    """Bounded LRU cache of trained models, keyed by ticker and model version.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum number of models kept in memory. By default, 128.
+    ttl : float, optional
+        Seconds a model stays in the cache after it was stored. By default,
+        3600.
+    version_key : callable, None, optional
+        Maps a version to a value that orders versions from oldest to
+        newest, so a slow load of an old version can't replace a newer one.
+        If `None`, versions are compared as they are. By default, `None`.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups answered from the cache.
+    misses : int
+        Number of lookups that found no usable entry.
+    evictions : int
+        Number of entries dropped because the cache was full.
+    """
+
+    def __init__(self, max_size=128, ttl=3600, version_key=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_key = version_key or (lambda version: version)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        # `(ticker, version)` -> `(model, expires_at)`, least recent first
+        self.__entries = OrderedDict()
+        # `ticker` -> latest version stored for it
+        self.__latest = {}
+
+    def get(self, ticker):
+        """Return latest cached model for `ticker`.
+
+        Parameters
+        ----------
+        ticker : str
+
+        Returns
+        -------
+        tuple, None
+            `(version, model)`, or `None` if there is no fresh entry.
+        """
+        with self.__lock:
+            version = self.__latest.get(ticker)
+            entry = self.__entries.get((ticker, version))
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self.__remove(ticker)
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end((ticker, version))
+            self.hits += 1
+            return version, entry[0]
+
+    def put(self, ticker, version, model):
+        """Store `model` as the latest version for `ticker`, replacing older
+        versions and evicting the least recently used entries if full.
+        Versions older than the cached one are ignored."""
+        with self.__lock:
+            cached = self.__latest.get(ticker)
+            if cached is not None and self.version_key(version) < self.version_key(cached):
+                return
+            self.__remove(ticker)
+            self.__entries[(ticker, version)] = (model, time.monotonic() + self.ttl)
+            self.__latest[ticker] = version
+            while len(self.__entries) > self.max_size:
+                (old_ticker, _), _ = self.__entries.popitem(last=False)
+                del self.__latest[old_ticker]
+                self.evictions += 1
+
+    def invalidate(self, ticker):
+        """Drop all cached versions for `ticker`."""
+        with self.__lock:
+            self.__remove(ticker)
+
+    def __remove(self, ticker):
+        version = self.__latest.pop(ticker, None)
+        self.__entries.pop((ticker, version), None)
+
+    def stats(self):
+        """Return size and counters of the cache as a dictionary."""
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ForecastCache:
+    """Bounded LRU cache of volatility forecasts, keyed by ticker, model
+    version and horizon.
+
+    Only the longest forecast computed for a model version is kept, shorter
+    horizons are served from its first days.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum number of model versions whose forecast is kept. By
+        default, 1024.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups answered from the cache.
+    misses : int
+        Number of lookups that found no long enough forecast.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        # `(ticker, version)` -> list of `(date, volatility)`, least recent first
+        self.__entries = OrderedDict()
+
+    def get(self, ticker, version, horizon):
+        """Return cached forecast of `horizon` days, `None` if there is no
+        cached forecast at least that long."""
+        with self.__lock:
+            entry = self.__entries.get((ticker, version))
+            if entry is None or len(entry) < horizon:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end((ticker, version))
+            self.hits += 1
+            return dict(entry[:horizon])
+
+    def put(self, ticker, version, forecast):
+        """Store `forecast`, a dictionary of dates and volatility, unless a
+        longer one is cached for the same model version."""
+        with self.__lock:
+            entry = self.__entries.get((ticker, version))
+            if entry is None or len(entry) < len(forecast):
+                self.__entries[(ticker, version)] = list(forecast.items())
+            self.__entries.move_to_end((ticker, version))
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, ticker):
+        """Drop forecasts of all model versions of `ticker`."""
+        with self.__lock:
+            for key in [key for key in self.__entries if key[0] == ticker]:
+                del self.__entries[key]
+
+    def stats(self):
+        """Return size and counters of the cache as a dictionary."""
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
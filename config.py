@@ -19,8 +19,56 @@ class Settings(BaseSettings):
     """Uses pydantic to define settings for project."""
 
     alpha_api_key: str
+    # Requests per minute allowed by the AlphaVantage plan
+    alpha_requests_per_minute: float = 5
+    # Requests that may be sent back to back
+    alpha_burst: int = 1
+    # Seconds before a request to AlphaVantage times out
+    alpha_timeout: float = 30
+    alpha_max_retries: int = 5
+    # SQLite file that shares the rate limit between processes, "" for none
+    alpha_rate_limit_path: str = return_full_path(".alpha_rate_limit.db")
+    # Directory of the AlphaVantage response cache, "" disables it
+    http_cache_directory: str = return_full_path(".cache/alphavantage")
+    # Replay recorded responses only, never call AlphaVantage
+    offline: bool = False
+    # Downloads in flight when fetching a watchlist
+    fetch_concurrency: int = 8
     db_name: str
+    # Price repository backend, "sqlite" or "parquet"
+    price_store: str = "sqlite"
+    # Directory of the Parquet price store
+    price_directory: str = return_full_path("prices")
     model_directory: str
+    # Connections kept open per mode (read-write and read-only)
+    db_pool_size: int = 4
+    # Seconds to wait for a free pooled connection
+    db_pool_timeout: float = 30
+    # Page cache per connection, negative values are in KiB
+    db_cache_size: int = -65536
+    # Bytes of the database file to memory-map per connection
+    db_mmap_size: int = 268435456
+    # Trained models kept in memory by the FastAPI service
+    model_cache_size: int = 128
+    # Seconds before a cached model is reloaded from disk
+    model_cache_ttl: float = 3600
+    # Models kept on disk per ticker, older ones are deleted after each fit
+    model_retention: int = 3
+    # Format of saved models, "pickle" (full `arch` result) or "compact"
+    model_format: str = "pickle"
+    # Start refits from the parameters of the previous model
+    warm_start: bool = True
+    # New observations since the previous model that don't require a refit
+    refit_tolerance: int = 0
+    # Forecasts kept in memory, one per model version
+    forecast_cache_size: int = 1024
+    # Seconds clients may reuse a forecast response
+    forecast_max_age: int = 300
+    # Worker processes for batch fits, 0 uses one per CPU core
+    fit_workers: int = 0
+    # Background fit jobs that run at the same time, and that can wait
+    fit_job_workers: int = 2
+    fit_job_queue_size: int = 100
 
     class Config:
         env_file = return_full_path(".env")
@@ -3,16 +3,576 @@ and the SQLite database. Remember that the API relies on a key that is
 stored in your `.env` file and imported via the `config` module.
 """
 
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import queue
+import random
+import re
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import itemgetter
+from zoneinfo import ZoneInfo
 
+import numpy as np
 import pandas as pd
 import requests
 from config import settings
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Number of observations returned by AlphaVantage for `output_size="compact"`
+COMPACT_SIZE = 100
+
+# Fields of a daily AlphaVantage observation kept by `parse_daily`
+DAILY_FIELDS = {
+    "1. open": "open",
+    "2. high": "high",
+    "3. low": "low",
+    "4. close": "close",
+    "5. adjusted close": "adjusted close",
+}
+
+# DataFrame column names and their counterparts in the `prices` table
+PRICE_COLUMNS = {
+    "open": "open",
+    "high": "high",
+    "low": "low",
+    "close": "close",
+    "adjusted close": "adjusted_close",
+}
+
+
+# One day of a daily payload, date and the fields in `DAILY_FIELDS`, which
+# AlphaVantage sends first and in this order
+DAILY_PATTERN = re.compile(
+    rb'"(\d{4}-\d{2}-\d{2})"\s*:\s*\{'
+    + rb",".join(
+        rb'\s*"' + re.escape(field.encode()) + rb'"\s*:\s*"([^"]*)"\s*'
+        for field in DAILY_FIELDS
+    )
+)
+
+
+def parse_daily(content, low_memory=False):
+    """Parse raw `TIME_SERIES_DAILY_ADJUSTED` JSON into a DataFrame.
+
+    By default, the payload is decoded in full, with `orjson` when it is
+    installed, which is the fastest path but briefly holds every field of
+    every day as Python strings (about 5 MB for a 20-year payload). With
+    `low_memory`, the payload is scanned for the fields in `DAILY_FIELDS`
+    instead, see `_scan_daily`, which allocates about a tenth of that but
+    takes longer than either decoder.
+
+    Parameters
+    ----------
+    content : bytes
+        Body of the AlphaVantage response.
+    low_memory : bool, optional
+        Whether to scan the payload instead of decoding it. By default,
+        `False`.
+
+    Returns
+    -------
+    pd.DataFrame, None
+        Index is DatetimeIndex "date". Columns are 'open', 'high', 'low',
+        'close', and 'adjusted close'. All columns are numeric. `None` if
+        the payload has no time series.
+    """
+    if low_memory:
+        return _scan_daily(content)
+    return _parse_daily_json(content)
+
+
+def _scan_daily(content):
+    """Parse daily payload by scanning it for the fields in `DAILY_FIELDS`,
+    which are written straight into a preallocated float array, see
+    `parse_daily`. Payloads the scan doesn't fully match, like error
+    messages, are decoded in full."""
+    n_days = content.count(b'"' + next(iter(DAILY_FIELDS)).encode() + b'"')
+    values = np.empty((n_days, len(DAILY_FIELDS)), dtype=float)
+    dates = np.empty(n_days, dtype="S10")
+    i = 0
+    for i, match in enumerate(DAILY_PATTERN.finditer(content), start=1):
+        if i > n_days:
+            break
+        # NumPy converts the matched bytes to floats on assignment
+        fields = match.groups()
+        dates[i - 1] = fields[0]
+        values[i - 1] = fields[1:]
+
+    # Fall back to decoding the whole payload if the scan missed any day
+    if i != n_days or n_days == 0:
+        return _parse_daily_json(content)
+
+    return pd.DataFrame(
+        values,
+        index=pd.DatetimeIndex(dates.astype("datetime64[ns]"), name="date"),
+        columns=list(DAILY_FIELDS.values()),
+    )
+
+
+def _parse_daily_json(content):
+    """Parse daily payload by decoding all of it, see `parse_daily`."""
+    response_data = orjson.loads(content) if orjson else json.loads(content)
+    stock_data = response_data.get("Time Series (Daily)")
+    if stock_data is None:
+        return None
+
+    # Convert all kept fields of all days to one float array at once
+    get_fields = itemgetter(*DAILY_FIELDS)
+    values = np.array([get_fields(day) for day in stock_data.values()], dtype=float)
+    values = values.reshape(len(stock_data), len(DAILY_FIELDS))
+    dates = np.array(list(stock_data), dtype="datetime64[ns]")
+
+    return pd.DataFrame(
+        values,
+        index=pd.DatetimeIndex(dates, name="date"),
+        columns=list(DAILY_FIELDS.values()),
+    )
+
+
+def sync_output_size(latest):
+    """Return AlphaVantage output size needed to bring a stored history up
+    to date.
+
+    Parameters
+    ----------
+    latest : pd.Timestamp, None
+        Date of the most recent stored observation, `None` if there is no
+        stored history.
+
+    Returns
+    -------
+    str, None
+        "compact" when fewer than `COMPACT_SIZE` sessions are missing,
+        "full" otherwise, `None` if no session is missing.
+    """
+    if latest is None:
+        return "full"
+
+    # Count business days missing since the latest stored observation
+    today = pd.Timestamp.now().normalize()
+    gap = len(pd.bdate_range(start=latest + pd.DateOffset(days=1), end=today))
+    if gap == 0:
+        return None
+
+    return "compact" if gap < COMPACT_SIZE else "full"
+
+
+def store_new_records(repo, ticker, records, latest):
+    """Store downloaded observations for `ticker` in `repo`.
+
+    Parameters
+    ----------
+    repo : SQLRepository
+    ticker : str
+    records : pd.DataFrame
+        Data returned by `AlphaVantageAPI.get_daily`.
+    latest : pd.Timestamp, None
+        Date of the most recent stored observation. If `None`, `records`
+        replace the stored history, otherwise observations from `latest` on
+        are upserted.
+
+    Returns
+    -------
+    int
+        Number of records written.
+    """
+    if latest is None:
+        repo.insert_table(table_name=ticker, records=records, if_exists="replace")
+        return len(records)
+
+    # Keep observations from the latest stored date on, the latest one may
+    # have been stored before the session closed
+    records = records[records.index >= latest]
+    if records.empty:
+        return 0
+
+    result = repo.insert_table(table_name=ticker, records=records, if_exists="upsert")
+    return result["records_inserted"] + result["records_updated"]
+
+
+class TokenBucket:
+    """Token-bucket rate limiter.
+
+    Tokens are added at `rate` per second up to `capacity`. Callers reserve
+    a token and wait until it is due, so concurrent callers are spaced out
+    instead of all retrying at once.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : float, optional
+        Maximum number of tokens that can be used in a burst. By default, 1.
+    state_path : str, None, optional
+        Path of a SQLite file that holds the bucket state, so that several
+        processes share one bucket. If `None`, the bucket only lives in this
+        process. By default, `None`.
+    """
+
+    def __init__(self, rate, capacity=1, state_path=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.__lock = threading.Lock()
+        self.__tokens = capacity
+        self.__updated = time.time()
+        self.__connection = None
+        if state_path:
+            self.__connection = sqlite3.connect(
+                state_path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket "
+                "(id INTEGER PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            self.__connection.execute(
+                "INSERT OR IGNORE INTO bucket VALUES (1, ?, ?)",
+                (self.__tokens, self.__updated),
+            )
+
+    def reserve(self, tokens=1):
+        """Take `tokens` from the bucket.
+
+        Returns
+        -------
+        float
+            Seconds to wait before the tokens may be used.
+        """
+        with self.__lock:
+            if self.__connection is not None:
+                # Lock shared state against other processes
+                self.__connection.execute("BEGIN IMMEDIATE")
+                self.__tokens, self.__updated = self.__connection.execute(
+                    "SELECT tokens, updated FROM bucket WHERE id = 1"
+                ).fetchone()
+
+            now = time.time()
+            available = min(
+                self.capacity, self.__tokens + (now - self.__updated) * self.rate
+            )
+            self.__tokens = available - tokens
+            self.__updated = now
+            delay = max(0.0, -self.__tokens / self.rate)
+
+            if self.__connection is not None:
+                self.__connection.execute(
+                    "UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1",
+                    (self.__tokens, self.__updated),
+                )
+                self.__connection.execute("COMMIT")
+
+        return delay
+
+    def acquire(self, tokens=1):
+        """Take `tokens` from the bucket, sleeping until they are due."""
+        time.sleep(self.reserve(tokens))
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of AlphaVantage responses.
+
+    Response bodies are stored once under the SHA-256 of their content.
+    Requests point to bodies through index entries keyed by their query
+    parameters, without the API key. Daily data only changes after the
+    market closes, so an entry expires at the first New York market close
+    after it was fetched, plus `close_delay` minutes.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where responses are stored.
+    offline : bool, optional
+        Whether to replay recorded responses only. Expired entries are
+        still served and misses raise an exception instead of going to the
+        network. By default, `False`.
+    close_delay : int, optional
+        Minutes after the 16:00 close until AlphaVantage has the day's data.
+        By default, 30.
+    """
+
+    timezone = ZoneInfo("America/New_York")
+
+    def __init__(self, directory, offline=False, close_delay=30):
+        self.directory = directory
+        self.offline = offline
+        self.close_delay = close_delay
+        os.makedirs(os.path.join(directory, "index"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+
+    @staticmethod
+    def key(params):
+        """Return cache key of a request with query `params`."""
+        params = {k: v for k, v in params.items() if k != "apikey"}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def expires_at(self, fetched_at):
+        """Return Unix time of the first market close, plus `close_delay`,
+        after Unix time `fetched_at`."""
+        fetched = datetime.datetime.fromtimestamp(fetched_at, tz=self.timezone)
+        close = fetched.replace(hour=16, minute=0, second=0, microsecond=0)
+        close += datetime.timedelta(minutes=self.close_delay)
+        # Move to next weekday if today's close has passed or it's a weekend
+        while close <= fetched or close.weekday() >= 5:
+            close += datetime.timedelta(days=1)
+        return close.timestamp()
+
+    def get(self, params):
+        """Return cached body for `params`, `None` if it's missing or
+        expired (always served in offline mode)."""
+        index_path = os.path.join(self.directory, "index", self.key(params))
+        try:
+            with open(index_path) as f:
+                entry = json.load(f)
+            if not self.offline and entry["expires_at"] <= time.time():
+                return None
+            with open(os.path.join(self.directory, "objects", entry["content"]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            if self.offline:
+                raise Exception(
+                    f"No recorded AlphaVantage response for {params.get('symbol')} "
+                    "in offline mode."
+                )
+            return None
+
+    def put(self, params, content):
+        """Store `content` as the body of the request with query `params`."""
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = os.path.join(self.directory, "objects", digest)
+        if not os.path.exists(object_path):
+            self.__write(object_path, content)
+
+        fetched_at = time.time()
+        entry = {
+            "params": {k: v for k, v in params.items() if k != "apikey"},
+            "content": digest,
+            "fetched_at": fetched_at,
+            "expires_at": self.expires_at(fetched_at),
+        }
+        index_path = os.path.join(self.directory, "index", self.key(params))
+        self.__write(index_path, json.dumps(entry).encode())
+
+    @staticmethod
+    def __write(path, content):
+        """Write file atomically, so readers never see partial content."""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def prune(self):
+        """Delete expired index entries and bodies no entry points to.
+
+        Returns
+        -------
+        int
+            Number of files deleted.
+        """
+        deleted, referenced = 0, set()
+        index_directory = os.path.join(self.directory, "index")
+        for name in os.listdir(index_directory):
+            path = os.path.join(index_directory, name)
+            with open(path) as f:
+                entry = json.load(f)
+            if entry["expires_at"] <= time.time():
+                os.remove(path)
+                deleted += 1
+            else:
+                referenced.add(entry["content"])
+
+        objects_directory = os.path.join(self.directory, "objects")
+        for name in os.listdir(objects_directory):
+            if name not in referenced:
+                os.remove(os.path.join(objects_directory, name))
+                deleted += 1
+
+        return deleted
+
+
+class AlphaVantageClient:
+    """HTTP client for the AlphaVantage API.
+
+    Keeps connections alive in a pool, spaces requests out with a
+    `TokenBucket` that matches the plan's per-minute quota, and retries
+    throttled or failed requests with exponential backoff.
+
+    Parameters
+    ----------
+    requests_per_minute : float, optional
+        Requests allowed per minute by the AlphaVantage plan. By default, 5.
+    burst : int, optional
+        Requests that may be sent back to back. By default, 1.
+    timeout : float, optional
+        Seconds to wait for the server to connect or send data. By default,
+        30.
+    max_retries : int, optional
+        Number of times a throttled or failed request is retried. By
+        default, 5.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled on every further
+        retry. By default, 2.
+    pool_size : int, optional
+        Connections kept alive. By default, 10.
+    rate_limit_path : str, None, optional
+        SQLite file that shares the rate limit between processes. By
+        default, `None`.
+    cache : ResponseCache, None, optional
+        Cache consulted before sending requests and filled with their
+        responses. By default, `None`.
+    """
+
+    url = "https://www.alphavantage.co/query"
+
+    def __init__(
+        self,
+        requests_per_minute=5,
+        burst=1,
+        timeout=30,
+        max_retries=5,
+        backoff=2,
+        pool_size=10,
+        rate_limit_path=None,
+        cache=None,
+    ):
+        self.cache = cache
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = TokenBucket(
+            rate=requests_per_minute / 60, capacity=burst, state_path=rate_limit_path
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+    def get(self, params):
+        """Send GET request with query `params`, return response body.
+
+        Fresh responses in `self.cache` are returned without a request.
+
+        Returns
+        -------
+        bytes
+
+        Raises
+        ------
+        Exception
+            If the request still fails after `max_retries` retries, or
+            AlphaVantage returns a message that retrying won't fix.
+        """
+        if self.cache is not None:
+            content = self.cache.get(params)
+            if content is not None:
+                return content
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = f"HTTP {response.status_code}"
+                else:
+                    response.raise_for_status()
+                    error = self.__throttle_message(response)
+                    if error is None:
+                        # Don't record errors, e.g. for unknown symbols
+                        is_error = b'"Error Message"' in response.content[:1024]
+                        if self.cache is not None and not is_error:
+                            self.cache.put(params, response.content)
+                        return response.content
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+
+            if attempt < self.max_retries:
+                delay = self.backoff * 2 ** attempt
+                time.sleep(delay + random.uniform(0, delay / 2))
+
+        raise Exception(
+            f"AlphaVantage request failed after {self.max_retries + 1} attempts: {error}"
+        )
+
+    @staticmethod
+    def __throttle_message(response):
+        """Return message if `response` says the quota was exceeded, `None`
+        if it's a regular payload."""
+        # Throttle messages are tiny, don't parse large payloads here
+        if len(response.content) > 1024:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        if "Note" in data:
+            return data["Note"]
+        message = data.get("Information")
+        if message is None:
+            return None
+        if "frequency" in message or "rate limit" in message:
+            return message
+        # Other messages, e.g. about premium endpoints, won't go away
+        raise Exception(f"AlphaVantage: {message}")
+
+
+# One client per process, shared by all `AlphaVantageAPI` instances
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return `ResponseCache` configured from `settings`, `None` if caching
+    is disabled."""
+    if not settings.http_cache_directory:
+        if settings.offline:
+            raise Exception("Offline mode needs `http_cache_directory` to be set.")
+        return None
+    return ResponseCache(settings.http_cache_directory, offline=settings.offline)
+
+
+def get_client():
+    """Return shared `AlphaVantageClient` configured from `settings`."""
+    with _clients_lock:
+        pid = os.getpid()
+        if pid not in _clients:
+            _clients[pid] = AlphaVantageClient(
+                requests_per_minute=settings.alpha_requests_per_minute,
+                burst=settings.alpha_burst,
+                timeout=settings.alpha_timeout,
+                max_retries=settings.alpha_max_retries,
+                rate_limit_path=settings.alpha_rate_limit_path or None,
+                cache=get_response_cache(),
+            )
+        return _clients[pid]
 
 
 class AlphaVantageAPI:
-    def __init__(self, api_key=settings.alpha_api_key):
+    def __init__(self, api_key=settings.alpha_api_key, client=None):
         self.__api_key = api_key
+        if client is None:
+            client = get_client()
+        self.__client = client
 
     def get_daily(self, ticker, output_size="full"):
         """Get daily time series of an equity from AlphaVantage API.
@@ -29,99 +589,880 @@ class AlphaVantageAPI:
         Returns
         -------
         pd.DataFrame
-            Columns are 'open', 'high', 'low', 'close', and 'volume'.
-            All columns are numeric.
-        """
-        url = (
-            "https://www.alphavantage.co/query?"
-            "function=TIME_SERIES_DAILY_ADJUSTED&"
-            f"symbol={ticker}&"
-            f"outputsize={output_size}&"
-            f"datatype=json&"
-            f"apikey={self.__api_key}"
-        )
-        # Send request to API
-        response = requests.get(url=url)
-        # Check if there's been an error
-        response_data = response.json()
+            Index is DatetimeIndex "date". Columns are 'open', 'high',
+            'low', 'close', and 'adjusted close'. All columns are numeric.
+        """
+        params = {
+            "function": "TIME_SERIES_DAILY_ADJUSTED",
+            "symbol": ticker,
+            "outputsize": output_size,
+            "datatype": "json",
+            "apikey": self.__api_key,
+        }
+        # Send request to API through rate-limited, caching client
+        content = self.__client.get(params)
+        # Parse results straight from the raw body
+        df = parse_daily(content)
 
-        if 'Time Series (Daily)' not in response_data.keys():
+        # Check if there's been an error
+        if df is None:
             raise Exception(
                 f"Invalid API call. Check ticker symbol '{ticker} is correct'"
             )
 
-        # Clean results
-        stock_data = response_data['Time Series (Daily)']
-        df = pd.DataFrame.from_dict(stock_data, orient="index", dtype=float)
-        df.index = pd.to_datetime(df.index)
-        df.index.name = "date"
-        df.columns = [c.split('. ')[1] for c in df.columns]
-        df.drop(columns=['dividend amount', 'split coefficient', 'volume'], inplace=True)
         # Return results
         return df
 
 
+class WatchlistFetcher:
+    """Download daily data for many tickers concurrently and store each
+    ticker's data as soon as it arrives.
+
+    Downloads and JSON parsing run in worker threads through
+    `AlphaVantageAPI`, so they share its connection pool and rate limiter.
+    Writes to the repository happen on the event loop one ticker at a time.
+
+    Parameters
+    ----------
+    pool : ConnectionPool
+        Pool of connections to the market-data database. A connection is
+        borrowed for each read of a ticker's latest date and for each write,
+        never while a download is rate-limited or in flight.
+    api : AlphaVantageAPI, None, optional
+        API used to download data. By default, a new `AlphaVantageAPI`.
+    concurrency : int, optional
+        Number of downloads in flight at the same time. By default, 8.
+    incremental : bool, optional
+        Whether to only download and store sessions missing since the
+        latest stored observation. By default, `True`.
+    """
+
+    def __init__(self, pool, api=None, concurrency=8, incremental=True):
+        self.pool = pool
+        self.api = api if api is not None else AlphaVantageAPI()
+        self.concurrency = concurrency
+        self.incremental = incremental
+
+    async def fetch(self, tickers):
+        """Download and store data for `tickers`.
+
+        Parameters
+        ----------
+        tickers : list
+
+        Returns
+        -------
+        dict
+            Each key is a ticker. Each value is a dictionary with keys
+            'success', 'records_inserted', 'message', and 'seconds'.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        async def download(ticker):
+            """Return `(ticker, start, latest, records)`, `records` is `None`
+            if nothing is missing and an exception if the download failed."""
+            start = time.perf_counter()
+            latest = None
+            if self.incremental:
+                with self.pool.connection(read_only=True) as connection:
+                    repo = get_repository(connection=connection)
+                    latest = repo.latest_date(table_name=ticker)
+            output_size = sync_output_size(latest)
+            if output_size is None:
+                return ticker, start, latest, None
+
+            async with semaphore:
+                try:
+                    records = await loop.run_in_executor(
+                        executor, self.api.get_daily, ticker, output_size
+                    )
+                except Exception as e:
+                    records = e
+            return ticker, start, latest, records
+
+        results = {}
+        try:
+            tasks = [download(ticker) for ticker in dict.fromkeys(tickers)]
+            # Store each ticker as soon as its download finishes
+            for task in asyncio.as_completed(tasks):
+                ticker, start, latest, records = await task
+                result = {"success": True, "records_inserted": 0, "message": ""}
+                try:
+                    if isinstance(records, Exception):
+                        raise records
+                    if records is not None:
+                        with self.pool.connection() as connection:
+                            result["records_inserted"] = store_new_records(
+                                repo=get_repository(connection=connection),
+                                ticker=ticker,
+                                records=records,
+                                latest=latest,
+                            )
+                except Exception as e:
+                    result["success"] = False
+                    result["message"] = str(e)
+                result["seconds"] = time.perf_counter() - start
+                results[ticker] = result
+        finally:
+            executor.shutdown(wait=False)
+
+        return results
+
+    def run(self, tickers):
+        """Run `fetch` in a new event loop, see `fetch`."""
+        return asyncio.run(self.fetch(tickers))
+
+
 class SQLRepository:
+    """Price store for daily equity data.
+
+    All tickers share the `prices` table, keyed by `(ticker, date)`. The
+    table is clustered on its primary key, so reading the most recent
+    observations for one ticker is an index seek whose cost does not grow
+    with the length of the history or the number of tickers stored.
+    """
+
+    # Rows written per `executemany` call by `upsert_table`
+    chunk_size = 500
+
     def __init__(self, connection):
         self.connection = connection
+        self.create_schema()
+
+    def create_schema(self):
+        """Create `prices` table and its indices if they don't exist."""
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS prices (
+                    ticker TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    open REAL,
+                    high REAL,
+                    low REAL,
+                    close REAL,
+                    adjusted_close REAL,
+                    PRIMARY KEY (ticker, date)
+                ) WITHOUT ROWID
+                """
+            )
+            # Covering index for reads that only need closing prices
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_prices_ticker_date_close "
+                "ON prices (ticker, date, close)"
+            )
 
     def insert_table(self, table_name, records, if_exists='fail'):
-        """Insert DataFrame into SQLite database as table
+        """Insert DataFrame into SQLite database for ticker `table_name`
 
         Parameters
         ----------
         table_name : str
+            Ticker symbol the records belong to.
         records : pd.DataFrame
+            Index is DatetimeIndex "date". Columns are a subset of
+            'open', 'high', 'low', 'close', and 'adjusted close'.
         if_exists : str, optional
-            How to behave if the table already exists.
+            How to behave if there are already records for the ticker.
 
             - 'fail': Raise a ValueError.
-            - 'replace': Drop the table before inserting new values.
-            - 'append': Insert new values to the existing table.
+            - 'replace': Delete the stored records before inserting new values.
+            - 'append': Insert new values next to the existing records.
+            - 'upsert': Insert new dates, update stored dates whose values
+              changed.
 
             Dafault: 'fail'
 
         Returns
         -------
         dict
-            Dictionary has two keys:
+            Dictionary has three keys:
 
             - 'transaction_successful', followed by bool
             - 'records_inserted', followed by int
+            - 'records_updated', followed by int
+        """
+        if if_exists == "upsert":
+            return self.upsert_table(table_name=table_name, records=records)
+
+        columns = [c for c in PRICE_COLUMNS if c in records.columns]
+        sql_columns = ", ".join(PRICE_COLUMNS[c] for c in columns)
+        placeholders = ", ".join("?" * (len(columns) + 2))
+        sql = f"INSERT INTO prices (ticker, date, {sql_columns}) VALUES ({placeholders})"
+
+        rows = zip(
+            [table_name] * len(records),
+            records.index.strftime("%Y-%m-%d"),
+            *(records[c].tolist() for c in columns),
+        )
+
+        # Write all records in a single transaction
+        with self.connection:
+            if self.latest_date(table_name) is not None:
+                if if_exists == "fail":
+                    raise ValueError(f"Table '{table_name}' already exists.")
+                if if_exists == "replace":
+                    self.connection.execute(
+                        "DELETE FROM prices WHERE ticker = ?", (table_name,)
+                    )
+            self.connection.executemany(sql, rows)
+
+        return {
+            "transaction_successful": True,
+            "records_inserted": len(records),
+            "records_updated": 0,
+        }
+
+    def upsert_table(self, table_name, records):
+        """Insert or update records for ticker `table_name` in a single
+        transaction.
+
+        Dates that are not stored yet are inserted, stored dates are only
+        rewritten if one of their values changed. Records are written in
+        chunks of `chunk_size` rows through one prepared statement.
+
+        Parameters
+        ----------
+        table_name : str
+            Ticker symbol the records belong to.
+        records : pd.DataFrame
+            Index is DatetimeIndex "date". Columns are a subset of
+            'open', 'high', 'low', 'close', and 'adjusted close'.
+
+        Returns
+        -------
+        dict
+            See `insert_table`.
         """
-        n_inserted = records.to_sql(
-            name=table_name, con=self.connection, if_exists=if_exists
+        columns = [PRICE_COLUMNS[c] for c in PRICE_COLUMNS if c in records.columns]
+        placeholders = ", ".join("?" * (len(columns) + 2))
+        assignments = ", ".join(f"{c} = excluded.{c}" for c in columns)
+        changed = " OR ".join(f"{c} IS NOT excluded.{c}" for c in columns)
+        sql = (
+            f"INSERT INTO prices (ticker, date, {', '.join(columns)}) "
+            f"VALUES ({placeholders}) "
+            f"ON CONFLICT (ticker, date) DO UPDATE SET {assignments} WHERE {changed}"
         )
+
+        dates = records.index.strftime("%Y-%m-%d").tolist()
+        values = [records[c].tolist() for c in PRICE_COLUMNS if c in records.columns]
+        rows = list(zip([table_name] * len(records), dates, *values))
+
+        inserted = updated = 0
+        with self.connection:
+            for i in range(0, len(rows), self.chunk_size):
+                chunk = rows[i:i + self.chunk_size]
+                # Stored dates of the chunk are updates, the rest inserts
+                chunk_dates = dates[i:i + self.chunk_size]
+                stored = self.connection.execute(
+                    "SELECT COUNT(*) FROM prices WHERE ticker = ? AND date IN "
+                    f"({', '.join('?' * len(chunk_dates))})",
+                    [table_name, *chunk_dates],
+                ).fetchone()[0]
+                changes = self.connection.total_changes
+                self.connection.executemany(sql, chunk)
+                changes = self.connection.total_changes - changes
+                inserted += len(chunk) - stored
+                updated += changes - (len(chunk) - stored)
+
         return {
             "transaction_successful": True,
-            "records_inserted": n_inserted
+            "records_inserted": inserted,
+            "records_updated": updated,
         }
 
-    def read_table(self, table_name, limit=None):
-        """Read table from database.
+    def read_table(self, table_name, limit=None, columns=None):
+        """Read records for ticker `table_name` from database.
 
         Parameters
         ----------
         table_name : str
-            Name of table in SQLite database.
+            Ticker symbol of the equity.
         limit : int, None, optional
             Number of most recent records to retrieve. If `None`, all
             records are retrieved. By default, `None`.
+        columns : list, None, optional
+            Columns to retrieve. If `None`, all columns are retrieved. By
+            default, `None`.
 
         Returns
         -------
         pd.DataFrame
-            Index is DatetimeIndex "date". Columns are 'open', 'high',
-            'low', 'close', and 'volume'. All columns are numeric.
+            Index is DatetimeIndex "date", most recent first. Columns are
+            'open', 'high', 'low', 'close', and 'adjusted close'. All
+            columns are numeric.
         """
+        return self.read_range(ticker=table_name, limit=limit, columns=columns)
+
+    def read_range(self, ticker, start=None, end=None, limit=None, columns=None):
+        """Read records for `ticker` between two dates from database.
+
+        Parameters
+        ----------
+        ticker : str
+            Ticker symbol of the equity.
+        start : str, pd.Timestamp, None, optional
+            First date to retrieve, inclusive. If `None`, there is no lower
+            bound. By default, `None`.
+        end : str, pd.Timestamp, None, optional
+            Last date to retrieve, inclusive. If `None`, there is no upper
+            bound. By default, `None`.
+        limit : int, None, optional
+            Number of most recent records in the range to retrieve. If
+            `None`, all records are retrieved. By default, `None`.
+        columns : list, None, optional
+            Columns to retrieve. If `None`, all columns are retrieved. By
+            default, `None`.
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is DatetimeIndex "date", most recent first. All columns
+            are numeric.
+        """
+        if columns is None:
+            columns = list(PRICE_COLUMNS)
+        select = ", ".join(f'{PRICE_COLUMNS[c]} AS "{c}"' for c in columns)
+
+        # Push filters, ordering and limit down to SQLite
+        sql = f"SELECT date, {select} FROM prices WHERE ticker = ?"
+        params = [ticker]
+        if start is not None:
+            sql += " AND date >= ?"
+            params.append(pd.Timestamp(start).strftime("%Y-%m-%d"))
+        if end is not None:
+            sql += " AND date <= ?"
+            params.append(pd.Timestamp(end).strftime("%Y-%m-%d"))
+        sql += " ORDER BY date DESC"
         if limit:
-            sql = f"SELECT * FROM '{table_name}' LIMIT {limit}"
+            sql += " LIMIT ?"
+            params.append(int(limit))
 
-        else:
-            sql = f"SELECT * FROM '{table_name}'"
-            # Retrieve data, read into DataFrame
+        # Retrieve data, read into DataFrame
         df = pd.read_sql(
-            sql=sql, con=self.connection, parse_dates=["date"], index_col="date"
+            sql=sql,
+            con=self.connection,
+            params=params,
+            parse_dates=["date"],
+            index_col="date",
         )
         # Return DataFrame
         return df
+
+    def latest_date(self, table_name):
+        """Return date of most recent record for ticker `table_name`.
+
+        Parameters
+        ----------
+        table_name : str
+            Ticker symbol of the equity.
+
+        Returns
+        -------
+        pd.Timestamp, None
+            Date of the most recent record. `None` if there are no records
+            for the ticker.
+        """
+        latest = self.connection.execute(
+            "SELECT MAX(date) FROM prices WHERE ticker = ?", (table_name,)
+        ).fetchone()[0]
+        if latest is None:
+            return None
+
+        return pd.Timestamp(latest)
+
+    def migrate_legacy_tables(self):
+        """Move per-ticker tables created by earlier versions of this class
+        into the `prices` table, then drop them.
+
+        Returns
+        -------
+        list
+            Tickers that were migrated.
+        """
+        tables = [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' "
+                "AND name NOT IN ('prices') AND name NOT LIKE 'sqlite_%'"
+            )
+        ]
+        migrated = []
+        for table in tables:
+            # Skip tables that don't hold price history
+            info = self.connection.execute(f"PRAGMA table_info('{table}')")
+            if not {"date", "close"} <= {row[1] for row in info}:
+                continue
+
+            if self.latest_date(table_name=table) is None:
+                df = pd.read_sql(
+                    sql=f"SELECT * FROM '{table}'",
+                    con=self.connection,
+                    parse_dates=["date"],
+                    index_col="date",
+                )
+                self.insert_table(table_name=table, records=df, if_exists="replace")
+            with self.connection:
+                self.connection.execute(f"DROP TABLE '{table}'")
+            migrated.append(table)
+
+        return migrated
+
+
+class ParquetRepository:
+    """Columnar price store for daily equity data.
+
+    Each ticker's history is one Parquet file in a Hive-style partition,
+    `{directory}/ticker={ticker}/prices.parquet`, sorted by date and split
+    into row groups. Reads only decode the requested columns, skip row
+    groups outside the requested dates using their statistics, and
+    memory-map the files. `read_many` loads several tickers in a single
+    dataset scan. Has the same interface as `SQLRepository`.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the Parquet files are stored.
+    """
+
+    # Rows per row group, the unit skipped by date filters and limits
+    row_group_size = 1024
+
+    # Serializes read-modify-write cycles of `insert_table`
+    _write_lock = threading.Lock()
+
+    def __init__(self, directory):
+        if pa is None:
+            raise Exception("ParquetRepository requires the `pyarrow` package.")
+        self.directory = directory
+        self.filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, table_name):
+        """Return path of the Parquet file of ticker `table_name`."""
+        return os.path.join(self.directory, f"ticker={table_name}", "prices.parquet")
+
+    def insert_table(self, table_name, records, if_exists='fail'):
+        """Write DataFrame to Parquet file for ticker `table_name`.
+
+        Parameters
+        ----------
+        table_name : str
+            Ticker symbol the records belong to.
+        records : pd.DataFrame
+            Index is DatetimeIndex "date". Columns are a subset of
+            'open', 'high', 'low', 'close', and 'adjusted close'.
+        if_exists : str, optional
+            How to behave if there are already records for the ticker.
+
+            - 'fail': Raise a ValueError.
+            - 'replace': Delete the stored records before inserting new values.
+            - 'append': Insert new values next to the existing records.
+            - 'upsert': Insert new dates, update stored dates whose values
+              changed.
+
+            Dafault: 'fail'
+
+        Returns
+        -------
+        dict
+            Dictionary has three keys:
+
+            - 'transaction_successful', followed by bool
+            - 'records_inserted', followed by int
+            - 'records_updated', followed by int
+        """
+        columns = [c for c in PRICE_COLUMNS if c in records.columns]
+        df = records[columns].astype("float64")
+        df.index = pd.DatetimeIndex(records.index, name="date").astype("datetime64[ns]")
+
+        inserted, updated = len(records), 0
+        path = self.path(table_name)
+        with self._write_lock:
+            if os.path.exists(path):
+                if if_exists == "fail":
+                    raise ValueError(f"Table '{table_name}' already exists.")
+                if if_exists in ("append", "upsert"):
+                    stored = pq.read_table(path, memory_map=True).to_pandas()
+                    stored = stored.set_index("date")
+                    if if_exists == "upsert":
+                        # Overwrite given columns of stored dates, keep the rest
+                        stored = stored.reindex(
+                            columns=stored.columns.union(columns, sort=False)
+                        )
+                        overlap = stored.index.intersection(df.index)
+                        new = df.loc[overlap].to_numpy()
+                        old = stored.loc[overlap, columns].to_numpy()
+                        # Same comparison as SQL `IS NOT`, NaN equals NaN
+                        differs = (new != old) & ~(np.isnan(new) & np.isnan(old))
+                        inserted = len(df) - len(overlap)
+                        updated = int(differs.any(axis=1).sum())
+                        stored.loc[overlap, columns] = new
+                        df = df.drop(overlap)
+                    df = pd.concat([stored, df])
+
+            # Parquet files are immutable, rewrite file sorted by date and
+            # swap it in atomically
+            df = df[~df.index.duplicated(keep="last")].sort_index()
+            table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            pq.write_table(table, tmp_path, row_group_size=self.row_group_size)
+            os.replace(tmp_path, path)
+
+        return {
+            "transaction_successful": True,
+            "records_inserted": inserted,
+            "records_updated": updated,
+        }
+
+    def read_table(self, table_name, limit=None, columns=None):
+        """Read records for ticker `table_name` from Parquet file.
+
+        Parameters
+        ----------
+        table_name : str
+            Ticker symbol of the equity.
+        limit : int, None, optional
+            Number of most recent records to retrieve. If `None`, all
+            records are retrieved. By default, `None`.
+        columns : list, None, optional
+            Columns to retrieve. If `None`, all columns are retrieved. By
+            default, `None`.
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is DatetimeIndex "date", most recent first. All columns
+            are numeric.
+        """
+        return self.read_range(ticker=table_name, limit=limit, columns=columns)
+
+    def read_range(self, ticker, start=None, end=None, limit=None, columns=None):
+        """Read records for `ticker` between two dates from Parquet file.
+
+        Parameters
+        ----------
+        ticker : str
+            Ticker symbol of the equity.
+        start : str, pd.Timestamp, None, optional
+            First date to retrieve, inclusive. If `None`, there is no lower
+            bound. By default, `None`.
+        end : str, pd.Timestamp, None, optional
+            Last date to retrieve, inclusive. If `None`, there is no upper
+            bound. By default, `None`.
+        limit : int, None, optional
+            Number of most recent records in the range to retrieve. If
+            `None`, all records are retrieved. By default, `None`.
+        columns : list, None, optional
+            Columns to retrieve. If `None`, all columns are retrieved. By
+            default, `None`.
+
+        Returns
+        -------
+        pd.DataFrame
+            Index is DatetimeIndex "date", most recent first. All columns
+            are numeric.
+        """
+        if columns is None:
+            columns = list(PRICE_COLUMNS)
+
+        path = self.path(ticker)
+        if not os.path.exists(path):
+            return self.__empty(columns)
+
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        stored = [c for c in columns if c in parquet_file.schema_arrow.names]
+        if start is None and end is None:
+            # Only decode the trailing row groups that hold the last `limit`
+            # records
+            groups = list(range(parquet_file.num_row_groups))
+            if limit:
+                n_rows = 0
+                for i in reversed(groups):
+                    n_rows += parquet_file.metadata.row_group(i).num_rows
+                    if n_rows >= limit:
+                        groups = groups[i:]
+                        break
+            table = parquet_file.read_row_groups(groups, columns=["date"] + stored)
+        else:
+            table = pq.read_table(
+                path,
+                columns=["date"] + stored,
+                filters=self.__date_filter(start, end),
+                memory_map=True,
+            )
+
+        return self.__to_frame(table, columns, limit)
+
+    def read_many(self, tickers, start=None, end=None, limit=None, columns=None):
+        """Read records for several tickers in one scan.
+
+        Parameters
+        ----------
+        tickers : list
+            Ticker symbols of the equities.
+        start, end, limit, columns
+            See `read_range`, `limit` applies to each ticker.
+
+        Returns
+        -------
+        dict
+            Maps each ticker to a DataFrame like the one returned by
+            `read_range`.
+        """
+        if columns is None:
+            columns = list(PRICE_COLUMNS)
+
+        paths = [self.path(ticker) for ticker in tickers]
+        paths = [path for path in paths if os.path.exists(path)]
+        frames = {}
+        if paths:
+            dataset = ds.dataset(
+                paths,
+                format="parquet",
+                filesystem=self.filesystem,
+                partitioning="hive",
+                partition_base_dir=self.directory,
+            )
+            stored = [c for c in columns if c in dataset.schema.names]
+            date_filter = self.__date_filter(start, end)
+            expression = None
+            if date_filter:
+                expression = pq.filters_to_expression(date_filter)
+            table = dataset.to_table(
+                columns=["ticker", "date"] + stored, filter=expression
+            )
+
+            # Files are sorted by date and normally scanned one after the
+            # other, only sort if the scan interleaved them
+            symbols = table.column("ticker").to_numpy(zero_copy_only=False)
+            bounds = np.flatnonzero(symbols[1:] != symbols[:-1]) + 1
+            starts = np.r_[0, bounds]
+            if len(symbols) and len(set(symbols[starts])) < len(starts):
+                table = table.sort_by([("ticker", "ascending"), ("date", "ascending")])
+                symbols = table.column("ticker").to_numpy(zero_copy_only=False)
+                bounds = np.flatnonzero(symbols[1:] != symbols[:-1]) + 1
+                starts = np.r_[0, bounds]
+
+            # Convert scan once, then split it into tickers
+            df = table.drop_columns(["ticker"]).to_pandas().set_index("date")
+            df = df.reindex(columns=columns)
+            ends = np.r_[bounds, len(symbols)]
+            for first, last in zip(starts, ends) if len(symbols) else ():
+                if limit:
+                    first = max(first, last - int(limit))
+                frames[symbols[first]] = df.iloc[first:last].iloc[::-1]
+
+        return {
+            ticker: frames[ticker] if ticker in frames else self.__empty(columns)
+            for ticker in tickers
+        }
+
+    def latest_date(self, table_name):
+        """Return date of most recent record for ticker `table_name`.
+
+        Read from the statistics of the last row group, without decoding
+        any data.
+
+        Parameters
+        ----------
+        table_name : str
+            Ticker symbol of the equity.
+
+        Returns
+        -------
+        pd.Timestamp, None
+            Date of the most recent record. `None` if there are no records
+            for the ticker.
+        """
+        path = self.path(table_name)
+        if not os.path.exists(path):
+            return None
+
+        metadata = pq.ParquetFile(path, memory_map=True).metadata
+        if metadata.num_rows == 0:
+            return None
+        column = metadata.schema.to_arrow_schema().get_field_index("date")
+        statistics = metadata.row_group(metadata.num_row_groups - 1).column(column).statistics
+
+        return pd.Timestamp(statistics.max)
+
+    @staticmethod
+    def __date_filter(start, end):
+        """Return Parquet filters selecting dates from `start` to `end`."""
+        date_filter = []
+        if start is not None:
+            date_filter.append(("date", ">=", pd.Timestamp(start)))
+        if end is not None:
+            date_filter.append(("date", "<=", pd.Timestamp(end)))
+        return date_filter or None
+
+    @staticmethod
+    def __to_frame(table, columns, limit):
+        """Convert Arrow `table` sorted by date to DataFrame most recent
+        first, keep last `limit` rows."""
+        if limit:
+            table = table.slice(max(0, table.num_rows - int(limit)))
+        df = table.to_pandas().set_index("date")
+        # Columns missing from the file read as NaN, like NULL in SQLite
+        return df.reindex(columns=columns).iloc[::-1]
+
+    @staticmethod
+    def __empty(columns):
+        """Return DataFrame without records."""
+        return pd.DataFrame(
+            columns=columns, index=pd.DatetimeIndex([], name="date"), dtype="float64"
+        )
+
+
+def get_repository(connection=None):
+    """Return price repository selected by `settings.price_store`.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection, None, optional
+        Connection to the market-data database, used by the "sqlite" store.
+        By default, `None`.
+
+    Returns
+    -------
+    SQLRepository, ParquetRepository
+    """
+    if settings.price_store == "parquet":
+        return ParquetRepository(directory=settings.price_directory)
+    if settings.price_store == "sqlite":
+        return SQLRepository(connection=connection)
+    raise Exception(f"Unknown price store '{settings.price_store}'.")
+
+
+class ConnectionPool:
+    """Process-wide pool of SQLite connections to the market-data database.
+
+    The database is switched to WAL journaling, so read-only connections
+    never wait for a connection that is writing a ticker's history.
+
+    Parameters
+    ----------
+    db_name : str
+        Path of the SQLite database.
+    size : int, optional
+        Number of connections kept open for each mode. By default, 4.
+    cache_size : int, optional
+        Value of `PRAGMA cache_size` for every connection. Negative values
+        are in KiB. By default, -65536 (64 MiB).
+    mmap_size : int, optional
+        Value of `PRAGMA mmap_size` for every connection. By default,
+        268435456 (256 MiB).
+    timeout : float, None, optional
+        Seconds to wait for a free connection before giving up. If `None`,
+        wait indefinitely. By default, 30.
+    """
+
+    def __init__(
+        self, db_name, size=4, cache_size=-65536, mmap_size=268435456, timeout=30
+    ):
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.__lock = threading.Lock()
+        self.__opened = {False: 0, True: 0}
+        self.__idle = {False: queue.LifoQueue(), True: queue.LifoQueue()}
+        self.__closed = False
+
+        # Open first connection eagerly so that the database file, WAL mode
+        # and schema exist before any read-only connection is opened. Tables
+        # of earlier versions are moved into `prices`, so their history isn't
+        # downloaded again
+        connection = self.__connect(read_only=False)
+        SQLRepository(connection=connection).migrate_legacy_tables()
+        self.__opened[False] += 1
+        self.__idle[False].put(connection)
+
+    def __connect(self, read_only):
+        """Open a new connection and apply pragmas."""
+        if read_only:
+            uri = pathlib.Path(self.db_name).absolute().as_uri() + "?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(self.db_name, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA busy_timeout=5000")
+        connection.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        if read_only:
+            connection.execute("PRAGMA query_only=ON")
+
+        return connection
+
+    @contextmanager
+    def connection(self, read_only=False):
+        """Borrow a connection from the pool.
+
+        Blocks until a connection is free once `size` connections of the
+        requested mode are in use, for at most `timeout` seconds.
+
+        Parameters
+        ----------
+        read_only : bool, optional
+            Whether to borrow a read-only connection. By default, `False`.
+
+        Yields
+        ------
+        sqlite3.Connection
+        """
+        if self.__closed:
+            raise Exception("Connection pool is closed.")
+
+        idle = self.__idle[read_only]
+        try:
+            connection = idle.get_nowait()
+        except queue.Empty:
+            with self.__lock:
+                can_open = self.__opened[read_only] < self.size
+                if can_open:
+                    self.__opened[read_only] += 1
+            if can_open:
+                try:
+                    connection = self.__connect(read_only)
+                except sqlite3.Error:
+                    with self.__lock:
+                        self.__opened[read_only] -= 1
+                    raise
+            else:
+                try:
+                    connection = idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    mode = "read-only" if read_only else "read-write"
+                    raise Exception(
+                        f"No {mode} database connection became free within "
+                        f"{self.timeout} seconds."
+                    ) from None
+
+        try:
+            yield connection
+        finally:
+            # Don't hand out connections with a transaction left open
+            if connection.in_transaction:
+                connection.rollback()
+            if self.__closed:
+                connection.close()
+            else:
+                idle.put(connection)
+
+    def close(self):
+        """Close all idle connections. Borrowed connections are closed when
+        they are returned."""
+        self.__closed = True
+        for idle in self.__idle.values():
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break
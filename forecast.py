@@ -0,0 +1,288 @@
+"""This module holds the compact artifact format for trained GARCH models.
+It only stores the fitted parameters and the last residuals and
+conditional variances, which is all that's needed to forecast volatility.
+Forecasts are computed with NumPy, so `arch` doesn't need to be imported.
+"""
+
+import json
+
+import numpy as np
+
+ARTIFACT_FORMAT = "garch-compact"
+ARTIFACT_VERSION = 1
+
+
+def garch_variance_paths(omega, alpha, beta, resid, variance, horizon):
+    """Forecast conditional variance of several GARCH(p, q) models at once.
+
+    Parameters
+    ----------
+    omega : np.ndarray
+        Shape `(n,)`. Constant of the variance equation of each model.
+    alpha : np.ndarray
+        Shape `(n, p)`. Coefficients of the lagged squared residuals, lag 1
+        first. Models of lower order are padded with zeros.
+    beta : np.ndarray
+        Shape `(n, q)`. Coefficients of the lagged conditional variances,
+        lag 1 first. Models of lower order are padded with zeros.
+    resid : np.ndarray
+        Shape `(n, p)`. Last `p` residuals of each model, oldest first.
+    variance : np.ndarray
+        Shape `(n, q)`. Last `q` conditional variances of each model,
+        oldest first.
+    horizon : int
+        Number of steps to forecast.
+
+    Returns
+    -------
+    np.ndarray
+        Shape `(n, horizon)`. Forecast variance of each model.
+    """
+    resid2 = np.asarray(resid, dtype=float) ** 2
+    variance = np.asarray(variance, dtype=float)
+    # Flip coefficients so that they line up with oldest-first history
+    alpha = np.asarray(alpha, dtype=float)[:, ::-1]
+    beta = np.asarray(beta, dtype=float)[:, ::-1]
+
+    paths = np.empty((len(omega), horizon))
+    for h in range(horizon):
+        step = omega + (alpha * resid2).sum(axis=1) + (beta * variance).sum(axis=1)
+        paths[:, h] = step
+        # Expected squared residual of a future step is its variance
+        resid2 = np.concatenate([resid2, step[:, None]], axis=1)[:, 1:]
+        variance = np.concatenate([variance, step[:, None]], axis=1)[:, 1:]
+
+    return paths
+
+
+def forecast_dates(last_date, horizon):
+    """Return ISO 8601 dates of the `horizon` business days after `last_date`.
+
+    Parameters
+    ----------
+    last_date : str
+        Date of the last training observation, ISO 8601 format.
+    horizon : int
+
+    Returns
+    -------
+    list
+    """
+    start = np.datetime64(last_date, "D") + 1
+    dates = np.busday_offset(start, np.arange(horizon), roll="forward")
+    return np.datetime_as_string(dates, unit="D").tolist()
+
+
+class CompactGarch:
+    """Fitted GARCH(p, q) model with constant mean, reduced to what is needed
+    to forecast volatility.
+
+    Atttributes
+    -----------
+    mu : float
+        Constant mean of the returns.
+    omega : float
+        Constant of the variance equation.
+    alpha : np.ndarray
+        Coefficients of the lagged squared residuals, lag 1 first.
+    beta : np.ndarray
+        Coefficients of the lagged conditional variances, lag 1 first.
+    resid : np.ndarray
+        Last `p` residuals of the training data, oldest first.
+    variance : np.ndarray
+        Last `q` conditional variances of the training data, oldest first.
+    last_date : str
+        Date of the last training observation, ISO 8601 format.
+
+    Methods
+    -------
+    from_result
+        Create from a fitted `arch` model.
+    forecast_variance
+        Forecast conditional variance.
+    predict_volatility
+        Generate volatility forecast, keyed by date.
+    save
+        Save to JSON file.
+    load
+        Load from JSON file.
+    """
+
+    def __init__(self, mu, omega, alpha, beta, resid, variance, last_date):
+        self.mu = float(mu)
+        self.omega = float(omega)
+        self.alpha = np.asarray(alpha, dtype=float)
+        self.beta = np.asarray(beta, dtype=float)
+        self.resid = np.asarray(resid, dtype=float)
+        self.variance = np.asarray(variance, dtype=float)
+        self.last_date = last_date
+
+    @property
+    def p(self):
+        return len(self.alpha)
+
+    @property
+    def q(self):
+        return len(self.beta)
+
+    @classmethod
+    def from_result(cls, result):
+        """Create from an `ARCHModelResult` of a constant mean GARCH model.
+
+        Parameters
+        ----------
+        result : arch.univariate.base.ARCHModelResult
+
+        Returns
+        -------
+        CompactGarch
+        """
+        params = result.params
+        alpha = params[[k for k in params.index if k.startswith("alpha[")]]
+        beta = params[[k for k in params.index if k.startswith("beta[")]]
+        resid = result.resid.dropna()
+        variance = (result.conditional_volatility ** 2).dropna()
+        p, q = len(alpha), len(beta)
+
+        return cls(
+            mu=params["mu"],
+            omega=params["omega"],
+            alpha=alpha.values,
+            beta=beta.values,
+            resid=resid.values[len(resid) - p:],
+            variance=variance.values[len(variance) - q:],
+            last_date=resid.index[-1].date().isoformat(),
+        )
+
+    def forecast_variance(self, horizon):
+        """Forecast conditional variance for the next `horizon` days.
+
+        Returns
+        -------
+        np.ndarray
+        """
+        return garch_variance_paths(
+            omega=np.array([self.omega]),
+            alpha=self.alpha[None, :],
+            beta=self.beta[None, :],
+            resid=self.resid[None, :],
+            variance=self.variance[None, :],
+            horizon=horizon,
+        )[0]
+
+    def predict_volatility(self, horizon):
+        """Generate volatility forecast for the next `horizon` days.
+
+        Returns
+        -------
+        dict
+            Forecast of volatility. Each key is date in ISO 8601 format.
+            Each value is predicted volatility.
+        """
+        volatility = np.sqrt(self.forecast_variance(horizon))
+        return dict(zip(forecast_dates(self.last_date, horizon), volatility.tolist()))
+
+    def to_dict(self):
+        """Return artifact contents as a JSON serializable dictionary."""
+        return {
+            "format": ARTIFACT_FORMAT,
+            "version": ARTIFACT_VERSION,
+            "mu": self.mu,
+            "omega": self.omega,
+            "alpha": self.alpha.tolist(),
+            "beta": self.beta.tolist(),
+            "resid": self.resid.tolist(),
+            "variance": self.variance.tolist(),
+            "last_date": self.last_date,
+        }
+
+    @classmethod
+    def from_dict(cls, artifact):
+        """Create from the dictionary returned by `to_dict`."""
+        if artifact.get("format") != ARTIFACT_FORMAT:
+            raise ValueError("Not a compact GARCH artifact.")
+        return cls(
+            mu=artifact["mu"],
+            omega=artifact["omega"],
+            alpha=artifact["alpha"],
+            beta=artifact["beta"],
+            resid=artifact["resid"],
+            variance=artifact["variance"],
+            last_date=artifact["last_date"],
+        )
+
+    def save(self, filepath):
+        """Save artifact to `filepath` as JSON."""
+        with open(filepath, "w") as f:
+            json.dump(self.to_dict(), f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, filepath):
+        """Load artifact saved with `save` from `filepath`."""
+        with open(filepath) as f:
+            return cls.from_dict(json.load(f))
+
+
+def to_compact(model):
+    """Return `model` as a `CompactGarch`, converting `arch` results."""
+    if isinstance(model, CompactGarch):
+        return model
+    return CompactGarch.from_result(model)
+
+
+def predict_volatility_batch(models, horizons):
+    """Generate volatility forecasts for several models at once.
+
+    The variance paths of all models are computed together from stacked
+    parameter arrays, models of lower order are padded with zeros.
+
+    Parameters
+    ----------
+    models : list
+        `CompactGarch` models.
+    horizons : list
+        Horizon of the forecast for each model.
+
+    Returns
+    -------
+    list
+        Forecast of volatility for each model. Each item is a dictionary,
+        keys are dates in ISO 8601 format and values are predicted
+        volatility.
+    """
+    if not models:
+        return []
+
+    n = len(models)
+    p = max(model.p for model in models)
+    q = max(model.q for model in models)
+    horizon = max(horizons)
+
+    # Stack parameters, pad higher lags with zero coefficients and oldest
+    # history with zeros
+    omega = np.empty(n)
+    alpha = np.zeros((n, p))
+    beta = np.zeros((n, q))
+    resid = np.zeros((n, p))
+    variance = np.zeros((n, q))
+    for i, model in enumerate(models):
+        omega[i] = model.omega
+        alpha[i, :model.p] = model.alpha
+        beta[i, :model.q] = model.beta
+        resid[i, p - model.p:] = model.resid
+        variance[i, q - model.q:] = model.variance
+
+    volatility = np.sqrt(
+        garch_variance_paths(omega, alpha, beta, resid, variance, horizon)
+    ).tolist()
+
+    # Models trained on the same day share their forecast dates
+    dates = {}
+    for model in models:
+        if model.last_date not in dates:
+            dates[model.last_date] = forecast_dates(model.last_date, horizon)
+
+    return [
+        dict(zip(dates[model.last_date][:h], volatility[i][:h]))
+        for i, (model, h) in enumerate(zip(models, horizons))
+    ]
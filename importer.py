@@ -0,0 +1,328 @@
+"""This module imports bank statements into a user's `income` and `expenses`
+tables. Statements are parsed as a stream and written in chunks, one
+`executemany` transaction per chunk, while the ledger and rollup triggers are
+paused. Aggregates and savings are recomputed once at the end, so importing a
+year of history costs about as much as a few thousand single inserts.
+
+Supported formats are CSV exports, with a signed amount column or separate
+debit and credit columns, and OFX/QFX statements (SGML or XML).
+"""
+
+import csv
+import datetime
+import functools
+import itertools
+import os
+import re
+import time
+
+from user import create_database, deferred_aggregates, unit_of_work
+
+# Header names recognized in CSV statements, compared in lower case
+CSV_COLUMNS = {
+    "date": ("date", "transaction date", "posted date", "posting date", "booking date"),
+    "amount": ("amount", "transaction amount", "amt"),
+    "debit": ("debit", "withdrawal", "withdrawals", "money out"),
+    "credit": ("credit", "deposit", "deposits", "money in"),
+    "description": ("description", "name", "payee", "memo", "details", "narrative"),
+    "category": ("category",),
+}
+
+# Date formats tried in order when a statement doesn't specify one
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d", "%d.%m.%Y", "%Y%m%d")
+
+# Keywords of transaction descriptions, in lower case, and their category
+CATEGORY_RULES = {
+    "grocery": "Groceries",
+    "supermarket": "Groceries",
+    "market": "Groceries",
+    "restaurant": "Dining",
+    "cafe": "Dining",
+    "coffee": "Dining",
+    "uber": "Transport",
+    "lyft": "Transport",
+    "fuel": "Transport",
+    "gas station": "Transport",
+    "rent": "Rent",
+    "electric": "Utilities",
+    "water": "Utilities",
+    "internet": "Utilities",
+    "phone": "Utilities",
+    "netflix": "Entertainment",
+    "spotify": "Entertainment",
+    "pharmacy": "Health",
+    "insurance": "Insurance",
+}
+
+DEFAULT_CATEGORY = "Other"
+
+
+class Transaction:
+    """
+    A validated statement line.
+
+    :param date: Date in 'YYYY-MM-DD' format.
+    :param amount: Signed amount, negative for expenses.
+    :param description: Text of the bank, used to categorize expenses.
+    :param category: Category given by the statement, if any.
+    """
+
+    __slots__ = ("date", "amount", "description", "category")
+
+    def __init__(self, date, amount, description="", category=None):
+        self.date = date
+        self.amount = amount
+        self.description = description
+        self.category = category
+
+
+def parse_date(value, date_format=None):
+    """
+    Parses a statement date.
+
+    :param value: Date text. OFX timestamps like '20240131120000[-5:EST]' are accepted.
+    :param date_format: `strptime` format, `DATE_FORMATS` are tried if None.
+    :return: Date in 'YYYY-MM-DD' format.
+    """
+    value = value.strip()
+    if date_format in (None, "%Y%m%d") and re.fullmatch(r"\d{8}(\d{6}.*)?", value):
+        value = value[:8]
+    for candidate in (date_format,) if date_format else DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, candidate).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date '{value}'.")
+
+
+def detect_date_format(values):
+    """
+    Returns the format of `DATE_FORMATS` that reads all dates of a statement. Dates
+    no format parses are ignored, they are reported as invalid lines later.
+
+    :param values: Date texts of the statement.
+    :return: The format, None if no date parses, e.g. for a statement without lines.
+    :raises ValueError: If several formats read every date, like '%m/%d/%Y' and
+        '%d/%m/%Y' for a statement whose days are all 12 or less, or if the dates
+        mix formats.
+    """
+    candidates, any_parsed = list(DATE_FORMATS), False
+    for value in values:
+        parsed_by = [f for f in DATE_FORMATS if _parses(value, f)]
+        if not parsed_by:
+            continue
+        any_parsed = True
+        candidates = [f for f in candidates if f in parsed_by]
+        if len(candidates) <= 1:
+            break
+    if not any_parsed:
+        return None
+    if not candidates:
+        raise ValueError("Dates mix several formats, pass `date_format`.")
+    if len(candidates) > 1:
+        raise ValueError(f"Dates are ambiguous between {', '.join(candidates)}, pass `date_format`.")
+    return candidates[0]
+
+
+def _parses(value, date_format):
+    try:
+        parse_date(value, date_format)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_amount(value):
+    """
+    Parses a statement amount like '1,234.50', '-12.00' or '(12.00)'.
+
+    :param value: Amount text, empty for 0.
+    :return: The amount.
+    """
+    value = value.strip().replace(",", "").replace("$", "")
+    if value.startswith("(") and value.endswith(")"):
+        value = "-" + value[1:-1]
+    return float(value) if value else 0.0
+
+
+def categorize(transaction, rules=None):
+    """
+    Returns the category of an expense, the statement's own category if it has one,
+    otherwise the category of the first keyword in `rules` found as whole words in its
+    description.
+
+    :param transaction: The transaction.
+    :param rules: Keyword to category mapping, `CATEGORY_RULES` if None.
+    """
+    if transaction.category:
+        return transaction.category
+    description = transaction.description.lower()
+    for keyword, category in (rules or CATEGORY_RULES).items():
+        if _keyword_pattern(keyword).search(description):
+            return category
+    return DEFAULT_CATEGORY
+
+
+@functools.lru_cache(maxsize=1024)
+def _keyword_pattern(keyword):
+    # Whole words only, so 'rent' doesn't match 'CURRENT' or 'TORRENT'
+    return re.compile(rf"\b{re.escape(keyword)}\b")
+
+
+def read_csv(f, date_format=None, errors=None):
+    """
+    Yields the transactions of a CSV statement. Lines that fail validation are
+    skipped and reported in `errors`.
+
+    :param f: Text file of the statement.
+    :param date_format: `strptime` format of the dates. If None, it is detected from the
+        dates of the statement with `detect_date_format`, `f` must then be seekable.
+    :param errors: List that receives '(line number, message)' of skipped lines.
+    """
+    start = f.tell()
+    reader = csv.reader(f)
+    header = [name.strip().lower() for name in next(reader, [])]
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header:
+                columns[field] = header.index(name)
+                break
+    if "date" not in columns or not ("amount" in columns or {"debit", "credit"} & set(columns)):
+        raise ValueError("CSV statement needs a date column and an amount or debit/credit columns.")
+
+    def get(row, field):
+        return row[columns[field]] if field in columns and columns[field] < len(row) else ""
+
+    # Settle on one date format for the whole statement, from a first pass
+    # over its distinct dates, so day-first and month-first readings are
+    # never mixed
+    if date_format is None:
+        date_format = detect_date_format(dict.fromkeys(get(row, "date") for row in reader if any(row)))
+        f.seek(start)
+        reader = csv.reader(f)
+        next(reader)
+
+    # Statements repeat a few hundred dates, parse each of them once
+    dates = {}
+
+    for line_number, row in enumerate(reader, start=2):
+        if not any(row):
+            continue
+        try:
+            if "amount" in columns:
+                amount = parse_amount(get(row, "amount"))
+            else:
+                amount = parse_amount(get(row, "credit")) - abs(parse_amount(get(row, "debit")))
+            if amount == 0:
+                raise ValueError("Amount is zero.")
+            date = get(row, "date")
+            if date not in dates:
+                dates[date] = parse_date(date, date_format)
+            yield Transaction(
+                date=dates[date],
+                amount=amount,
+                description=get(row, "description").strip(),
+                category=get(row, "category").strip() or None,
+            )
+        except ValueError as e:
+            if errors is not None:
+                errors.append((line_number, str(e)))
+
+
+def read_ofx(f, errors=None):
+    """
+    Yields the transactions (`STMTTRN` aggregates) of an OFX statement. Both SGML
+    statements, whose leaf elements aren't closed, and XML statements are read one
+    line at a time. Transactions that fail validation are skipped and reported in
+    `errors`.
+
+    :param f: Text file of the statement.
+    :param errors: List that receives '(transaction number, message)' of skipped lines.
+    """
+    fields, number = None, 0
+    for line in f:
+        for closing, tag, value in re.findall(r"<(/?)([A-Za-z0-9.]+)>([^<]*)", line):
+            tag = tag.upper()
+            if tag == "STMTTRN" and not closing:
+                fields = {}
+            elif tag == "STMTTRN" and closing and fields is not None:
+                number += 1
+                try:
+                    amount = parse_amount(fields.get("TRNAMT", ""))
+                    if amount == 0:
+                        raise ValueError("Amount is zero.")
+                    yield Transaction(
+                        date=parse_date(fields.get("DTPOSTED", "")),
+                        amount=amount,
+                        description=fields.get("NAME") or fields.get("MEMO", ""),
+                    )
+                except ValueError as e:
+                    if errors is not None:
+                        errors.append((number, str(e)))
+                fields = None
+            elif fields is not None and not closing and value.strip():
+                fields[tag] = value.strip()
+
+
+def import_statement(username, path, statement_format=None, chunk_size=5000, rules=None, date_format=None):
+    """
+    Imports a bank statement into the income and expenses of a user. Credits become
+    income and debits become expenses, categorized with `categorize`.
+
+    :param username: The username of the user.
+    :param path: Path of the statement file.
+    :param statement_format: 'csv' or 'ofx', guessed from the file extension if None.
+    :param chunk_size: Number of transactions written per transaction.
+    :param rules: Keyword to category mapping, `CATEGORY_RULES` if None.
+    :param date_format: `strptime` format of CSV dates, detected if None.
+    :return: Dictionary with keys 'income' and 'expenses', the number of rows imported;
+        'skipped', the number of invalid lines; 'errors', the first 100 of them; and 'seconds'.
+    """
+    start = time.perf_counter()
+    if statement_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        statement_format = "ofx" if extension in (".ofx", ".qfx") else "csv"
+    if statement_format not in ("csv", "ofx"):
+        raise ValueError(f"Unknown statement format '{statement_format}'.")
+
+    create_database(username)
+    result = {"income": 0, "expenses": 0, "skipped": 0, "errors": []}
+    errors = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if statement_format == "csv":
+            transactions = read_csv(f, date_format=date_format, errors=errors)
+        else:
+            transactions = read_ofx(f, errors=errors)
+
+        # Statements repeat a few hundred descriptions, categorize each of them once
+        categories = {}
+
+        def category(t):
+            key = (t.category, t.description)
+            if key not in categories:
+                categories[key] = categorize(t, rules)
+            return categories[key]
+
+        # Write chunks without per-row trigger work, aggregate once at the end
+        with deferred_aggregates(username):
+            while True:
+                chunk = list(itertools.islice(transactions, chunk_size))
+                if not chunk:
+                    break
+                income = [(t.amount, t.date) for t in chunk if t.amount > 0]
+                expenses = [(-t.amount, category(t), t.date) for t in chunk if t.amount < 0]
+                with unit_of_work(username) as conn:
+                    conn.executemany("INSERT INTO income (amount, date) VALUES (?, ?)", income)
+                    conn.executemany("INSERT INTO expenses (amount, category, date) VALUES (?, ?, ?)", expenses)
+                result["income"] += len(income)
+                result["expenses"] += len(expenses)
+
+    result["skipped"] = len(errors)
+    result["errors"] = errors[:100]
+    result["seconds"] = time.perf_counter() - start
+
+    print(f"Imported {result['income']} income and {result['expenses']} expense records, "
+          f"skipped {result['skipped']} lines.")
+
+    return result
@@ -0,0 +1,172 @@
+"""This module runs long tasks, like fitting a model, in background worker
+threads so that the FastAPI service can answer with a job ID right away
+and clients can poll for the result.
+"""
+
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+PENDING = "pending"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class Job:
+    """Unit of work tracked by a `JobQueue`.
+
+    Atttributes
+    -----------
+    job_id : str
+        Unique ID of the job.
+    key : hashable
+        Identifies equivalent jobs, used to deduplicate pending ones.
+    state : str
+        One of 'pending', 'running', 'succeeded', or 'failed'.
+    progress : float
+        Fraction of the work done, between 0 and 1.
+    stage : str
+        Description of the step the job is in.
+    result : object
+        Return value of the job function once it succeeded.
+    message : str
+        Error message if the job failed.
+    """
+
+    def __init__(self, key, function, kwargs):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.function = function
+        self.kwargs = kwargs
+        self.state = PENDING
+        self.progress = 0.0
+        self.stage = "queued"
+        self.result = None
+        self.message = ""
+        self.created_at = pd.Timestamp.now()
+        self.started_at = None
+        self.finished_at = None
+
+    def report(self, progress, stage):
+        """Update `progress` and `stage`, passed to the job function as its
+        `progress` argument."""
+        self.progress = progress
+        self.stage = stage
+
+    def to_dict(self):
+        """Return job status as a JSON serializable dictionary."""
+        end = self.finished_at or pd.Timestamp.now()
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "progress": self.progress,
+            "stage": self.stage,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "seconds": (end - (self.started_at or end)).total_seconds(),
+            "result": self.result,
+            "message": self.message,
+        }
+
+
+class JobQueue:
+    """Bounded queue of jobs executed by a fixed number of worker threads.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of jobs that run at the same time. By default, 2.
+    max_pending : int, optional
+        Number of jobs that can wait in the queue. By default, 100.
+    max_finished : int, optional
+        Number of finished jobs whose status is kept. By default, 1000.
+    """
+
+    def __init__(self, workers=2, max_pending=100, max_finished=1000):
+        self.max_finished = max_finished
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__jobs = OrderedDict()
+        self.__pending = {}
+        self.__threads = [
+            threading.Thread(target=self.__work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, key, function, **kwargs):
+        """Queue `function(progress=job.report, **kwargs)`.
+
+        If a job with the same `key` is still pending, that job is returned
+        instead of queueing a new one.
+
+        Parameters
+        ----------
+        key : hashable
+        function : callable
+
+        Returns
+        -------
+        Job
+        """
+        with self.__lock:
+            job = self.__pending.get(key)
+            if job is not None:
+                return job
+
+            job = Job(key=key, function=function, kwargs=kwargs)
+            try:
+                self.__queue.put_nowait(job)
+            except queue.Full:
+                raise Exception("Too many pending jobs, try again later.")
+            self.__pending[key] = job
+            self.__jobs[job.job_id] = job
+
+        return job
+
+    def get(self, job_id):
+        """Return job with `job_id`, `None` if it's unknown."""
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def __work(self):
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                break
+
+            with self.__lock:
+                self.__pending.pop(job.key, None)
+                job.state = RUNNING
+                job.started_at = pd.Timestamp.now()
+            try:
+                job.result = job.function(progress=job.report, **job.kwargs)
+                job.state = SUCCEEDED
+                job.report(1.0, "done")
+            except Exception as e:
+                job.state = FAILED
+                job.message = str(e)
+            job.finished_at = pd.Timestamp.now()
+            self.__forget_finished()
+
+    def __forget_finished(self):
+        """Drop status of oldest finished jobs beyond `max_finished`."""
+        with self.__lock:
+            finished = [
+                job_id for job_id, job in self.__jobs.items()
+                if job.state in (SUCCEEDED, FAILED)
+            ]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.__jobs[job_id]
+
+    def shutdown(self):
+        """Stop worker threads once queued jobs are done."""
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
@@ -1,16 +1,35 @@
-import sqlite3
-
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from backtest import BacktestStore, check_settings, run_backtest
+from cache import ForecastCache, ModelCache
 from config import settings
-from data import SQLRepository
-from fastapi import FastAPI
-from model import GarchModel
+from data import (
+    AlphaVantageAPI,
+    ConnectionPool,
+    WatchlistFetcher,
+    get_repository,
+    store_new_records,
+    sync_output_size,
+)
+from forecast import predict_volatility_batch, to_compact
+from fastapi import FastAPI, Header, HTTPException, Response
+from jobs import JobQueue
+from model import CRITERIA, GarchModel, version_timestamp
+from registry import get_registry
+from singleflight import SingleFlight
 from pydantic import BaseModel
 import requests
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
+import hashlib
 import secrets
+import time
 
 
 # `FitIn` class
@@ -18,14 +37,56 @@ class FitIn(BaseModel):
     ticker: str
     use_new_data: bool
     n_observations: int
-    p: int
-    q: int
+    p: int = 1
+    q: int = 1
+    background: bool = False
+    select_order: bool = False
+    max_p: int = 4
+    max_q: int = 4
+    criterion: str = "bic"
 
 
 # `FitOut` class
 class FitOut(FitIn):
     success: bool
     message: str
+    job_id: str = None
+    candidates: List[dict] = None
+
+
+# `JobOut` class
+class JobOut(BaseModel):
+    job_id: str
+    state: str
+    progress: float
+    stage: str
+    created_at: str
+    started_at: str = None
+    finished_at: str = None
+    seconds: float
+    result: dict = None
+    message: str
+
+
+# `FitBatchIn` class
+class FitBatchIn(BaseModel):
+    items: List[FitIn]
+
+
+# `FitBatchResult` class
+class FitBatchResult(FitOut):
+    wrangle_seconds: float
+    fit_seconds: float
+    dump_seconds: float
+    seconds: float
+    iterations: Optional[int] = None
+
+
+# `FitBatchOut` class
+class FitBatchOut(BaseModel):
+    success: bool
+    results: List[FitBatchResult]
+    seconds: float
 
 
 # `PredictIn` class
@@ -41,23 +102,243 @@ class PredictOut(PredictIn):
     message: str
 
 
-# model build function
-def build_model(ticker, use_new_data):
-    # Create DB connection
-    connection = sqlite3.connect(settings.db_name, check_same_thread=False)
+# `PredictBatchIn` class
+class PredictBatchIn(BaseModel):
+    items: List[PredictIn]
+
+
+# `PredictBatchOut` class
+class PredictBatchOut(BaseModel):
+    success: bool
+    results: List[PredictOut]
+    seconds: float
+
+
+# `BacktestIn` class
+class BacktestIn(BaseModel):
+    ticker: str
+    use_new_data: bool = False
+    n_observations: int = 2520
+    window: int = 500
+    refit_every: int = 20
+    p: int = 1
+    q: int = 1
+    include_forecast: bool = False
 
-    # Create `SQLRepository`
-    repo = SQLRepository(connection=connection)
+
+# `BacktestOut` class
+class BacktestOut(BacktestIn):
+    success: bool
+    message: str
+    metrics: dict = None
+    blocks_computed: int = 0
+    fit_seconds: float = 0.0
+    seconds: float
+    forecast: dict = None
+
+
+# model build function
+def build_model(ticker, use_new_data, connection):
+    # Create repository of the configured price store
+    repo = get_repository(connection=connection)
 
     # Create model
-    model = GarchModel(ticker=ticker, use_new_data=use_new_data, repo=repo)
+    model = GarchModel(
+        ticker=ticker,
+        use_new_data=use_new_data,
+        repo=repo,
+        registry=app.state.registry,
+    )
+
+    # Return model
+    return model
+
+
+# model load function
+def load_model(ticker):
+    # Create model, no repository needed to generate predictions
+    model = GarchModel(
+        ticker=ticker, repo=None, use_new_data=False, registry=app.state.registry
+    )
+
+    # Use cached model if there is one, otherwise load it. Concurrent misses
+    # for the same ticker share one load
+    cached = app.state.model_cache.get(ticker)
+    if cached is None:
+        cached = app.state.single_flight.do(("load", ticker), _load_into_cache, model)
+    model.version, model.model = cached
 
     # Return model
     return model
 
 
+def _load_into_cache(model):
+    """Load `model` from disk, cache its compact form, return `(version,
+    compact model)`."""
+    model.load()
+    compact = to_compact(model.model)
+    # Don't cache a version superseded while it was loading, the cache keeps
+    # newer ones anyway but may have been invalidated since
+    latest = app.state.registry.latest(model.ticker)
+    if latest is None or os.path.basename(latest["path"]) == model.version:
+        app.state.model_cache.put(model.ticker, model.version, compact)
+    return model.version, compact
+
+
+# forecast function
+def forecast_volatility(model, n_days):
+    if n_days < 1:
+        raise ValueError("'n_days' must be at least 1.")
+    # Serve forecast from cache if this model version already forecast at
+    # least `n_days`, otherwise generate and cache it
+    forecast = app.state.forecast_cache.get(model.ticker, model.version, n_days)
+    if forecast is None:
+        forecast = app.state.single_flight.do(
+            ("forecast", model.ticker, model.version, n_days),
+            model.predict_volatility,
+            horizon=n_days,
+        )
+        app.state.forecast_cache.put(model.ticker, model.version, forecast)
+
+    # Return forecast
+    return forecast
+
+
+def forecast_etag(model, n_days):
+    """Return ETag of the forecast of `model` for `n_days`."""
+    key = f"{model.ticker}:{model.version}:{n_days}".encode()
+    return '"' + hashlib.sha256(key).hexdigest()[:32] + '"'
+
+
+def sync_ticker(ticker):
+    """Download observations of `ticker` missing from the price store and
+    store them, return the number of records written.
+
+    Connections are only borrowed to read the latest stored date and to
+    write the download, never while waiting on the rate limiter or retries.
+    """
+    with app.state.db_pool.connection(read_only=True) as connection:
+        latest = get_repository(connection=connection).latest_date(table_name=ticker)
+    output_size = sync_output_size(latest)
+    if output_size is None:
+        return 0
+
+    records = AlphaVantageAPI().get_daily(ticker=ticker, output_size=output_size)
+    with app.state.db_pool.connection() as connection:
+        return store_new_records(
+            repo=get_repository(connection=connection),
+            ticker=ticker,
+            records=records,
+            latest=latest,
+        )
+
+
+def _ignore_progress(progress, stage):
+    pass
+
+
+# model train function
+def train_model(
+    ticker,
+    use_new_data,
+    n_observations,
+    p,
+    q,
+    select_order=False,
+    max_p=4,
+    max_q=4,
+    criterion="bic",
+    progress=_ignore_progress,
+):
+    # Download new data, concurrent fits of the ticker share one download
+    if use_new_data:
+        progress(0.05, "downloading data")
+        app.state.single_flight.do(("sync", ticker), sync_ticker, ticker)
+    # Borrow read-only connection, build model with `build_model` function
+    with app.state.db_pool.connection(read_only=True) as connection:
+        model = build_model(ticker=ticker, use_new_data=False, connection=connection)
+        # Wrangle data
+        progress(0.1, "wrangling data")
+        model.wrangle_data(n_observations=n_observations)
+    candidates = None
+    if select_order:
+        # Fit every order up to (`max_p`, `max_q`) in worker processes, keep
+        # the best one
+        progress(0.3, "selecting order")
+        candidates = model.select_order(
+            p_values=range(1, max_p + 1),
+            q_values=range(1, max_q + 1),
+            criterion=criterion,
+            executor=app.state.process_pool,
+        )
+    else:
+        # Keep latest model if the window barely moved since it was trained
+        if model.is_current(p=p, q=q, tolerance=settings.refit_tolerance):
+            file_name = model.registry.latest(ticker)["path"]
+            message = f"'{file_name}' is current, skipped refit."
+            return {"file_name": file_name, "message": message, "p": p, "q": q}
+        # Fit model, starting from the previous parameters
+        progress(0.5, "fitting model")
+        model.fit(p=p, q=q, warm_start=settings.warm_start)
+    # Save model, replace cached version
+    progress(0.9, "saving model")
+    file_name = model.dump()
+    app.state.model_cache.put(ticker, model.version, to_compact(model.model))
+    app.state.forecast_cache.invalidate(ticker)
+
+    # Return result
+    return {
+        "file_name": file_name,
+        "message": f"Trained and saved '{file_name}'.",
+        "p": model.p,
+        "q": model.q,
+        "candidates": candidates,
+    }
+
+
+def train_model_coalesced(progress=_ignore_progress, **params):
+    """Run `train_model`, sharing the result of an identical fit that is
+    already running."""
+    key = ("fit",) + tuple(sorted(params.items()))
+    return app.state.single_flight.do(key, train_model, progress=progress, **params)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Open the market-data connection pool on startup and close it on
+    shutdown."""
+    app.state.db_pool = ConnectionPool(
+        db_name=settings.db_name,
+        size=settings.db_pool_size,
+        cache_size=settings.db_cache_size,
+        mmap_size=settings.db_mmap_size,
+        timeout=settings.db_pool_timeout,
+    )
+    app.state.registry = get_registry(settings.model_directory)
+    app.state.model_cache = ModelCache(
+        max_size=settings.model_cache_size,
+        ttl=settings.model_cache_ttl,
+        version_key=version_timestamp,
+    )
+    app.state.forecast_cache = ForecastCache(max_size=settings.forecast_cache_size)
+    app.state.single_flight = SingleFlight()
+    # Spawn workers, forking would copy the open SQLite connections
+    app.state.process_pool = ProcessPoolExecutor(
+        max_workers=settings.fit_workers or None,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    app.state.fit_jobs = JobQueue(
+        workers=settings.fit_job_workers, max_pending=settings.fit_job_queue_size
+    )
+    app.state.backtests = BacktestStore(settings.model_directory)
+    yield
+    app.state.fit_jobs.shutdown()
+    app.state.process_pool.shutdown()
+    app.state.db_pool.close()
+
+
 # Call FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 API_KEY = secrets.token_urlsafe(32)
 print(API_KEY)
@@ -134,6 +415,14 @@ app.openapi = custom_openapi
 def fit_model(request: FitIn):
     """Fit model, return confirmation message.
 
+    If `request.background` is `True`, the fit is queued and the response
+    carries the ID of the job to poll at `/jobs/{job_id}`. A pending job
+    with the same parameters is reused instead of queueing a duplicate.
+
+    If `request.select_order` is `True`, every (p, q) up to
+    (`request.max_p`, `request.max_q`) is fit in parallel, the best one by
+    `request.criterion` is saved and the response lists all candidates.
+
     Parameters
     ----------
     request : FitIn
@@ -146,20 +435,38 @@ def fit_model(request: FitIn):
     # Create `response` dictionary from `request`
     response = request.dict()
 
+    params = request.dict(exclude={"background"})
+
     # Create try block to handle exceptions
     try:
-        # Build model with `build_model` function
-        model = build_model(ticker=request.ticker, use_new_data=request.use_new_data)
-        # Wrangle data
-        model.wrangle_data(n_observations=request.n_observations)
-        # Fit model
-        model.fit(p=request.p, q=request.q)
-        # Save model
-        file_name = model.dump()
+        # Check order search up front, a background job would only fail later
+        if request.select_order:
+            if request.max_p < 1 or request.max_q < 1:
+                raise ValueError("`max_p` and `max_q` must be at least 1.")
+            if request.criterion not in CRITERIA:
+                raise ValueError(
+                    f"Unknown information criterion '{request.criterion}', "
+                    f"expected one of {', '.join(CRITERIA)}."
+                )
+        if request.background:
+            # Queue job with `train_model` function
+            job = app.state.fit_jobs.submit(
+                key=tuple(params.items()), function=train_model_coalesced, **params
+            )
+            response["success"] = True
+            response["job_id"] = job.job_id
+            response["message"] = f"Queued fit job '{job.job_id}'."
+            return response
+
+        # Train model, share result with identical fits in flight
+        result = train_model_coalesced(**params)
         # Add `"success"` key to `response`
         response["success"] = True
         # Add `"message"` key to `response` with `filename`
-        response["message"] = f"Trained and saved '{file_name}'."
+        response["message"] = result["message"]
+        # Report orders that were fit, and the candidates if they were selected
+        response["p"], response["q"] = result["p"], result["q"]
+        response["candidates"] = result.get("candidates")
     # Create except block
     except Exception as e:
         # Add `"success"` key to `response`
@@ -170,19 +477,109 @@ def fit_model(request: FitIn):
     return response
 
 
+@app.post("/fit/batch", status_code=200, response_model=FitBatchOut)
+def fit_batch(request: FitBatchIn):
+    """Fit models for several tickers in parallel worker processes, return
+    result and timings for each one.
+
+    Parameters
+    ----------
+    request : FitBatchIn
+
+    Returns
+    ------
+    dict
+        Must conform to `FitBatchOut` class
+    """
+    start = time.perf_counter()
+    # Batches fit the requested orders, order selection is only done by `/fit`
+    jobs = [
+        item.dict(include={"ticker", "use_new_data", "n_observations", "p", "q"})
+        for item in request.items
+    ]
+
+    # Download new data for all tickers concurrently, within the rate limit
+    tickers = [job["ticker"] for job in jobs if job["use_new_data"]]
+    downloads = {}
+    if tickers:
+        fetcher = WatchlistFetcher(
+            pool=app.state.db_pool, concurrency=settings.fetch_concurrency
+        )
+        downloads = fetcher.run(tickers)
+
+    # Fan jobs whose data is ready out over process pool, they train on
+    # stored data
+    ready = [
+        dict(job, use_new_data=False) for job in jobs
+        if downloads.get(job["ticker"], {"success": True})["success"]
+    ]
+    fitted = iter(GarchModel.fit_batch(ready, executor=app.state.process_pool))
+
+    # Combine jobs with their results, drop stale cached models
+    results = []
+    for job in jobs:
+        download = downloads.get(job["ticker"], {"success": True, "seconds": 0.0})
+        if download["success"]:
+            result = next(fitted)
+            result["wrangle_seconds"] += download["seconds"]
+            result["seconds"] += download["seconds"]
+        else:
+            result = {
+                "success": False,
+                "message": download["message"],
+                "wrangle_seconds": download["seconds"],
+                "fit_seconds": 0.0,
+                "dump_seconds": 0.0,
+                "seconds": download["seconds"],
+            }
+        result.update(job)
+        results.append(result)
+        if result["success"]:
+            app.state.model_cache.invalidate(job["ticker"])
+            app.state.forecast_cache.invalidate(job["ticker"])
+
+    return {
+        "success": all(result["success"] for result in results),
+        "results": results,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+@app.get("/jobs/{job_id}", status_code=200, response_model=JobOut)
+def get_job(job_id: str):
+    """Return state, progress, timing and result of a background fit job.
+
+    Parameters
+    ----------
+    job_id : str
+        ID returned by `/fit` with `background` set.
+
+    Returns
+    ------
+    dict
+        Must conform to `JobOut` class
+    """
+    job = app.state.fit_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job '{job_id}'.")
+    return job.to_dict()
+
+
 @app.post("/predict", status_code=200, response_model=PredictOut)
 # Task 8.4.19 `"/predict" path, 200 status code
-def get_prediction(request: PredictIn):
+def get_prediction(request: PredictIn, http_response: Response):
     # Create `response` dictionary from `request`
     response = request.dict()
     # Create try block to handle exceptions
     try:
-        # Build model with `build_model` function
-        model = build_model(ticker=request.ticker, use_new_data=False)
-        # Load stored model
-        model.load()
-        # Generate prediction
-        prediction = model.predict_volatility(horizon=request.n_days)
+        # Load stored model with `load_model` function
+        model = load_model(ticker=request.ticker)
+        # Generate prediction with `forecast_volatility` function
+        prediction = forecast_volatility(model=model, n_days=request.n_days)
+        http_response.headers["ETag"] = forecast_etag(model, request.n_days)
+        http_response.headers["Cache-Control"] = (
+            f"private, max-age={settings.forecast_max_age}"
+        )
         # Add `"success"` key to `response`
         response["success"] = True
         # Add `"forecast"` key to `response`
@@ -199,3 +596,196 @@ def get_prediction(request: PredictIn):
         response["message"] = str(e)
     # Return response
     return response
+
+
+@app.get("/predict/{ticker}", status_code=200, response_model=PredictOut)
+def get_prediction_cacheable(
+    ticker: str, n_days: int, if_none_match: str = Header(default=None)
+):
+    """Generate volatility forecast, cacheable by browsers and proxies.
+
+    Responses carry an ETag that changes when the ticker is refitted, a
+    request with a matching `If-None-Match` header gets an empty 304
+    response.
+
+    Parameters
+    ----------
+    ticker : str
+    n_days : int
+
+    Returns
+    ------
+    dict
+        Must conform to `PredictOut` class
+    """
+    response = {"ticker": ticker, "n_days": n_days}
+    try:
+        if n_days < 1:
+            raise ValueError("'n_days' must be at least 1.")
+        model = load_model(ticker=ticker)
+    except Exception as e:
+        response.update(success=False, forecast={}, message=str(e))
+        return response
+
+    headers = {
+        "ETag": forecast_etag(model, n_days),
+        "Cache-Control": f"public, max-age={settings.forecast_max_age}",
+    }
+    if if_none_match == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        forecast = forecast_volatility(model=model, n_days=n_days)
+        response.update(success=True, forecast=forecast, message="")
+    except Exception as e:
+        response.update(success=False, forecast={}, message=str(e))
+
+    # Only cache successful forecasts
+    if not response["success"]:
+        return response
+    return JSONResponse(content=response, headers=headers)
+
+
+@app.get("/cache", status_code=200)
+def get_cache_stats():
+    """Return size and hit/miss counters of the model and forecast caches."""
+    return {
+        "models": app.state.model_cache.stats(),
+        "forecasts": app.state.forecast_cache.stats(),
+        "single_flight": app.state.single_flight.stats(),
+    }
+
+
+@app.get("/models", status_code=200)
+def list_models(ticker: str = None):
+    """Return registry records of saved models, most recent first.
+
+    Parameters
+    ----------
+    ticker : str, optional
+        Only return models of this ticker.
+    """
+    return app.state.registry.list(ticker=ticker)
+
+
+@app.post("/backtest", status_code=200, response_model=BacktestOut)
+def backtest_model(request: BacktestIn):
+    """Backtest one-day-ahead volatility forecasts over the last
+    `request.n_observations` returns of a ticker, return their scores.
+
+    Windows are fit in parallel worker processes. Forecasts are cached, so
+    repeating a backtest only computes windows added since the last run.
+    If `request.include_forecast` is `True`, the response carries forecast
+    and realized volatility for each day.
+
+    Parameters
+    ----------
+    request : BacktestIn
+
+    Returns
+    ------
+    dict
+        Must conform to `BacktestOut` class
+    """
+    start = time.perf_counter()
+    response = request.dict()
+    try:
+        # Check settings before downloading or reading any data
+        check_settings(
+            window=request.window,
+            refit_every=request.refit_every,
+            p=request.p,
+            q=request.q,
+        )
+        # Load returns once, concurrent downloads of the ticker are shared
+        if request.use_new_data:
+            app.state.single_flight.do(("sync", request.ticker), sync_ticker, request.ticker)
+        with app.state.db_pool.connection(read_only=True) as connection:
+            model = build_model(
+                ticker=request.ticker, use_new_data=False, connection=connection
+            )
+            model.wrangle_data(n_observations=request.n_observations)
+
+        result = run_backtest(
+            ticker=request.ticker,
+            returns=model.data,
+            window=request.window,
+            refit_every=request.refit_every,
+            p=request.p,
+            q=request.q,
+            store=app.state.backtests,
+            executor=app.state.process_pool,
+        )
+        response["success"] = True
+        response["message"] = ""
+        response["metrics"] = result["metrics"]
+        response["blocks_computed"] = result["blocks_computed"]
+        response["fit_seconds"] = result["fit_seconds"]
+        if request.include_forecast:
+            forecast = result["forecast"]
+            forecast.index = forecast.index.strftime("%Y-%m-%d")
+            response["forecast"] = forecast.to_dict(orient="index")
+    except Exception as e:
+        response["success"] = False
+        response["message"] = str(e)
+
+    response["seconds"] = time.perf_counter() - start
+    return response
+
+
+@app.post("/predict/batch", status_code=200, response_model=PredictBatchOut)
+def get_prediction_batch(request: PredictBatchIn):
+    """Generate volatility forecasts for several tickers and horizons in one
+    pass.
+
+    Parameters
+    ----------
+    request : PredictBatchIn
+
+    Returns
+    ------
+    dict
+        Must conform to `PredictBatchOut` class
+    """
+    start = time.perf_counter()
+
+    # Load each ticker's model once
+    models, errors = {}, {}
+    for ticker in {item.ticker for item in request.items}:
+        try:
+            models[ticker] = load_model(ticker=ticker).model
+        except Exception as e:
+            errors[ticker] = str(e)
+
+    # Find error message of each item, `None` if it can be forecast
+    messages = []
+    for item in request.items:
+        if item.ticker in errors:
+            messages.append(errors[item.ticker])
+        elif item.n_days < 1:
+            messages.append("'n_days' must be at least 1.")
+        else:
+            messages.append(None)
+
+    # Forecast all valid items together
+    valid = [item for item, message in zip(request.items, messages) if message is None]
+    forecasts = iter(
+        predict_volatility_batch(
+            models=[models[item.ticker] for item in valid],
+            horizons=[item.n_days for item in valid],
+        )
+    )
+
+    results = []
+    for item, message in zip(request.items, messages):
+        response = item.dict()
+        response["success"] = message is None
+        response["forecast"] = next(forecasts) if message is None else {}
+        response["message"] = message or ""
+        results.append(response)
+
+    return {
+        "success": all(message is None for message in messages),
+        "results": results,
+        "seconds": time.perf_counter() - start,
+    }
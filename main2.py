@@ -9,11 +9,11 @@ import plotly.express as px
 import flask
 from dash import Dash, html, dcc
 from dash.dependencies import Input, Output, State
-import sqlite3
 from bs4 import BeautifulSoup
 
+from analytics import get_insights
 from user import authenticate, add_interests, get_interests, create_user, create_database, get_income, add_income, \
-    add_expense, update_income, delete_income, get_all_expenses, get_all_savings
+    add_expense, update_income, delete_income, get_all_savings, unit_of_work
 from flask import Flask, session
 import dash_bootstrap_components as dbc
 
@@ -24,18 +24,13 @@ app = Dash(__name__, server=server,
            external_stylesheets=['https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css',
                                  dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
 
-# Establish SQLite database connection
-conn = sqlite3.connect('users.db')
-c = conn.cursor()
-
 # Create users table if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS users
-             (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              username TEXT NOT NULL UNIQUE,
-              password TEXT NOT NULL,
-              interests TEXT);''')
-conn.commit()
-conn.close()
+with unit_of_work() as conn:
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     username TEXT NOT NULL UNIQUE,
+                     password TEXT NOT NULL,
+                     interests TEXT);''')
 
 # Update the app layout
 app.layout = html.Div(
@@ -1010,6 +1005,7 @@ def execute_add_income(n_clicks, amount, date):
 insights_layout = html.Div([
     generate_navbar(),
     html.H3("Insights", style={'text-align': 'center', 'margin': '20px'}),
+    dcc.Store(id='insights-data'),
     html.Div(id='insights-output', style={'text-align': 'center'}),
     dcc.Graph(id='pie-chart'),
     html.Div([
@@ -1024,18 +1020,24 @@ insights_layout = html.Div([
 ])
 
 
-# Callback function to update the expenses chart
-@app.callback(Output('expenses-chart', 'figure'), [Input('url', 'search')])
-def update_expenses_chart(search):
+# Callback function to load the aggregates shared by the Insights charts
+@app.callback(Output('insights-data', 'data'), [Input('url', 'search')])
+def load_insights(search):
     username = session.get('username')
     if username:
-        expenses = get_all_expenses(username)
+        # One snapshot of pre-aggregated data instead of a full table load per chart
+        return get_insights(username)
+    else:
+        return None
 
-        # Create a dataframe from the expenses data
-        df_expenses = pd.DataFrame(expenses, columns=['ID', 'Amount', 'Category', 'Date'])
 
-        # Group expenses by category and calculate the total amount
-        category_expenses = df_expenses.groupby('Category')['Amount'].sum().sort_values(ascending=False).reset_index()
+# Callback function to update the expenses chart
+@app.callback(Output('expenses-chart', 'figure'), [Input('insights-data', 'data')])
+def update_expenses_chart(insights):
+    if insights:
+        # Expenses by category, summed in SQL
+        category_expenses = pd.DataFrame(insights['categories'], columns=['category', 'amount'])
+        category_expenses.columns = ['Category', 'Amount']
 
         # Create a pie chart of expenses by category using Plotly Express
         fig = px.pie(category_expenses, values='Amount', names='Category',
@@ -1047,20 +1049,15 @@ def update_expenses_chart(search):
 
 
 # Callback function to update the expenses chart
-@app.callback(Output('m_expenses-chart', 'figure'), [Input('url', 'search')])
-def update_m_expenses_chart(search):
-    username = session.get('username')
-    if username:
-        expenses = get_all_expenses(username)
-
-        # Create a dataframe from the expenses data
-        df_expenses = pd.DataFrame(expenses, columns=['ID', 'Amount', 'Category', 'Date'])
+@app.callback(Output('m_expenses-chart', 'figure'), [Input('insights-data', 'data')])
+def update_m_expenses_chart(insights):
+    if insights:
+        # Expenses by date, summed in SQL
+        daily_expenses = pd.DataFrame(insights['daily_expenses'], columns=['date', 'amount'])
+        daily_expenses.columns = ['Date', 'Amount']
 
         # Convert the date column to datetime format
-        df_expenses['Date'] = pd.to_datetime(df_expenses['Date'])
-
-        # Group expenses by date and calculate the total amount
-        daily_expenses = df_expenses.groupby('Date')['Amount'].sum().reset_index()
+        daily_expenses['Date'] = pd.to_datetime(daily_expenses['Date'])
 
         # Create a line plot of expenses by date using Plotly Express
         fig = px.line(daily_expenses, x='Date', y='Amount', labels={'Date': 'Date', 'Amount': 'Expenses'},
@@ -1072,21 +1069,15 @@ def update_m_expenses_chart(search):
 
 
 # Callback function to update the income chart
-@app.callback(Output('income-chart', 'figure'), [Input('url', 'search')])
-def update_income_chart(search):
-    username = session.get('username')
-    if username:
-        income = get_income(username)
-        df_income = pd.DataFrame(income, columns=['ID', 'Amount', 'Date'])
-        df_income['Date'] = pd.to_datetime(df_income['Date'])
-        monthly_income = df_income.groupby(df_income['Date'].dt.to_period('M')).sum(numeric_only=True)['Amount']
-
-        # Convert Period object to string for plotting
-        monthly_income.index = monthly_income.index.astype(str)
+@app.callback(Output('income-chart', 'figure'), [Input('insights-data', 'data')])
+def update_income_chart(insights):
+    if insights:
+        # Income by month in 'YYYY-MM' format, summed in SQL
+        monthly_income = pd.DataFrame(insights['monthly_income'], columns=['month', 'amount'])
 
         # Create a line plot of income by month using Plotly Express
-        fig = px.line(x=monthly_income.index, y=monthly_income, labels={'x': 'Date (Year-Month)', 'y': 'Income'},
-                      title='Monthly Income')
+        fig = px.line(x=monthly_income['month'], y=monthly_income['amount'],
+                      labels={'x': 'Date (Year-Month)', 'y': 'Income'}, title='Monthly Income')
 
         return fig
     else:
@@ -1094,28 +1085,15 @@ def update_income_chart(search):
 
 
 # Callback function to retrieve and display insights
-@app.callback(Output('insights-output', 'children'), [Input('url', 'search')])
-def display_insights(search):
-    username = session.get('username')
-    if username:
-        db_name = f"{username}.db"
-        conn = sqlite3.connect(db_name)
-
-        # Retrieve data from income table
-        income_query = "SELECT * FROM income"
-        df_income = pd.read_sql_query(income_query, conn)
-        total_income = df_income['amount'].sum()
-
-        # Retrieve data from expenses table
-        expenses_query = "SELECT * FROM expenses"
-        df_expenses = pd.read_sql_query(expenses_query, conn)
-        total_expenses = df_expenses['amount'].sum()
-
-        conn.close()
+@app.callback(Output('insights-output', 'children'), [Input('insights-data', 'data')])
+def display_insights(insights):
+    if insights:
+        total_income = insights['total_income']
+        total_expenses = insights['total_expenses']
 
         # Calculate balance and expenditure percentage
         balance = total_income - total_expenses
-        expenditure_percent = (total_expenses / total_income) * 100
+        expenditure_percent = (total_expenses / total_income) * 100 if total_income else 0.0
 
         # Print other insights
         insights_text = [
@@ -1130,24 +1108,11 @@ def display_insights(search):
 
 
 # Callback function to update the pie chart
-@app.callback(Output('pie-chart', 'figure'), [Input('url', 'search')])
-def update_pie_chart(search):
-    username = session.get('username')
-    if username:
-        db_name = f"{username}.db"
-        conn = sqlite3.connect(db_name)
-
-        # Retrieve data from income table
-        income_query = "SELECT * FROM income"
-        df_income = pd.read_sql_query(income_query, conn)
-        total_income = df_income['amount'].sum()
-
-        # Retrieve data from expenses table
-        expenses_query = "SELECT * FROM expenses"
-        df_expenses = pd.read_sql_query(expenses_query, conn)
-        total_expenses = df_expenses['amount'].sum()
-
-        conn.close()
+@app.callback(Output('pie-chart', 'figure'), [Input('insights-data', 'data')])
+def update_pie_chart(insights):
+    if insights:
+        total_income = insights['total_income']
+        total_expenses = insights['total_expenses']
 
         # Create a bar chart of total income and expenses
         df_insights = pd.DataFrame({'Category': ['Income', 'Expenses'], 'Amount': [total_income, total_expenses]})
@@ -1421,34 +1386,67 @@ stocks_layout = html.Div([
         ),
 
         html.Div(id="prediction-output"),
+        dcc.Store(id="fit-job"),
+        dcc.Interval(id="fit-job-poll", interval=1000, disabled=True),
         dcc.Graph(id="prediction-graph", style={'margin-top': '30px'})
     ])
 ])
 
 
 @app.callback(
-    dash.dependencies.Output("prediction-output", "children"),
-    [dash.dependencies.Input("fit-button", "n_clicks")],
-    [dash.dependencies.State("ticker-input", "value")]
+    [dash.dependencies.Output("prediction-output", "children"),
+     dash.dependencies.Output("fit-job", "data"),
+     dash.dependencies.Output("fit-job-poll", "disabled")],
+    [dash.dependencies.Input("fit-button", "n_clicks"),
+     dash.dependencies.Input("fit-job-poll", "n_intervals")],
+    [dash.dependencies.State("ticker-input", "value"),
+     dash.dependencies.State("fit-job", "data")]
 )
-def fit_data(n_clicks, ticker):
-    if n_clicks > 0:
+def fit_data(n_clicks, n_intervals, ticker, job):
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+
+    # Poll status of the running fit job
+    if "fit-job-poll.n_intervals" in triggered and job:
+        # URL of `/jobs` path
+        url_job = f"http://localhost:8008/jobs/{job['job_id']}"
+        status = requests.get(url_job).json()
+
+        if status.get("state") == "succeeded":
+            return html.Div(f"Data fitted for {job['ticker']}.", style={"color": "green"}), None, True
+        if status.get("state") == "failed":
+            return html.Div(f"Fit failed for {job['ticker']}: {status['message']}", style={"color": "red"}), None, True
+        if "state" not in status:
+            return html.Div(f"Fit job for {job['ticker']} was lost.", style={"color": "red"}), None, True
+
+        progress = round(status["progress"] * 100)
+        return html.Div(f"Fitting {job['ticker']}: {status['stage']} ({progress}%)"), job, False
+
+    # Only a click submits a fit, poll ticks without a job must not restart one
+    if "fit-button.n_clicks" in triggered and n_clicks > 0:
         # URL of `/fit` path
         url_fit = "http://localhost:8008/fit"
 
-        # Data to send for fitting
+        # Data to send for fitting, queue fit in the background
         json_fit = {
             "ticker": ticker,
             "use_new_data": True,
             "n_observations": 2000,
             "p": 1,
-            "q": 1
+            "q": 1,
+            "background": True
         }
 
         # Make API request for fitting
-        response_fit = requests.post(url_fit, json=json_fit)
+        response_fit = requests.post(url_fit, json=json_fit).json()
+
+        if not response_fit.get("success"):
+            return html.Div(f"Fit failed for {ticker}: {response_fit.get('message')}", style={"color": "red"}), None, True
+
+        # Start polling job status
+        job = {"job_id": response_fit["job_id"], "ticker": ticker}
+        return html.Div(f"Fitting {ticker}: queued"), job, False
 
-        return html.Div(f"Data fitted for {ticker}.", style={"color": "green"})
+    return dash.no_update, dash.no_update, True
 
 
 # Callback function to update the graph based on user input
@@ -1,11 +1,24 @@
+import hashlib
+import io
+import json
+import multiprocessing
 import os
-from glob import glob
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import joblib
+import numpy as np
 import pandas as pd
 from arch import arch_model
 from config import settings
-from data import AlphaVantageAPI, SQLRepository
+from data import AlphaVantageAPI, get_repository, store_new_records, sync_output_size
+from forecast import CompactGarch
+from registry import get_registry
+
+# Information criteria `GarchModel.select_order` can rank candidates by
+CRITERIA = ("aic", "bic")
 
 class GarchModel:
     """Class for training GARCH model and generating predictions.
@@ -14,33 +27,88 @@ class GarchModel:
     -----------
     ticker : str
         Ticker symbol of the equity whose volatility will be predicted.
-    repo : SQLRepository
+    repo : SQLRepository, ParquetRepository
         The repository where the training data will be stored.
     use_new_data : bool
         Whether to download new data from the AlphaVantage API to train
         the model or to use the existing data stored in the repository.
     model_directory : str
         Path for directory where trained models will be stored.
+    incremental : bool
+        Whether new data should only be downloaded for the sessions missing
+        since the most recent observation in the repository. If `False`,
+        the full history is downloaded and replaces the stored table.
+    registry : ModelRegistry
+        Index of the models saved in `model_directory`.
+    version : str, None
+        File name of the trained model in `self.model`, `None` until the
+        model has been saved or loaded.
 
     Methods
     -------
+    sync_data
+        Download new data from AlphaVantage into the repository.
     wrangle_data
         Generate equity returns from data in database.
     fit
         Fit model to training data.
+    select_order
+        Fit the best of a grid of lag orders.
     predict
         Generate volatilty forecast from trained model.
     dump
         Save trained model to file.
     load
         Load trained model from file.
+    fit_batch
+        Train and save models for several tickers in parallel.
     """
 
-    def __init__(self, ticker, repo, use_new_data):
+    def __init__(self, ticker, repo, use_new_data, incremental=True, registry=None):
         self.ticker = ticker
         self.repo = repo
         self.use_new_data = use_new_data
+        self.incremental = incremental
         self.model_directory = settings.model_directory
+        if registry is None:
+            registry = get_registry(self.model_directory)
+        self.registry = registry
+        self.version = None
+        self.data = None
+        self.n_observations = None
+        self.p = None
+        self.q = None
+        self.iterations = None
+        self.fit_seconds = None
+
+    def sync_data(self):
+        """Download new observations for `self.ticker` from AlphaVantage and
+        store them in `self.repo`.
+
+        When `self.incremental` is `True` and the repository already holds
+        data for the ticker, only the sessions after the latest stored date
+        are written, see `sync_output_size` for the amount downloaded.
+
+        Returns
+        -------
+        int
+            Number of records written to the repository.
+        """
+        latest = None
+        if self.incremental:
+            latest = self.repo.latest_date(table_name=self.ticker)
+
+        # Skip download if no session is missing
+        output_size = sync_output_size(latest)
+        if output_size is None:
+            return 0
+
+        api = AlphaVantageAPI()
+        new_data = api.get_daily(ticker=self.ticker, output_size=output_size)
+
+        return store_new_records(
+            repo=self.repo, ticker=self.ticker, records=new_data, latest=latest
+        )
 
     def wrangle_data(self, n_observations):
         """Extract data from database (or get from AlphaVantage), transform it
@@ -57,15 +125,15 @@ class GarchModel:
         """
         # Add new data to database if required
         if self.use_new_data:
-            api = AlphaVantageAPI()
-
-            new_data = api.get_daily(ticker=self.ticker)
+            self.sync_data()
+        self.n_observations = n_observations
 
-            self.repo.insert_table(
-                table_name=self.ticker, records=new_data, if_exists="replace"
-            )
         # Pull data from SQL database
-        df = self.repo.read_table(table_name=self.ticker, limit=n_observations+1)
+        df = self.repo.read_table(
+            table_name=self.ticker, limit=n_observations+1, columns=["close"]
+        )
+        if df.empty:
+            raise Exception(f"No data stored for '{self.ticker}'.")
 
         # Clean data, attach to class as `data` attribute
         df.sort_index(ascending=True, inplace=True)
@@ -73,7 +141,7 @@ class GarchModel:
 
         self.data = df['return'].dropna()
 
-    def fit(self, p, q):
+    def fit(self, p, q, warm_start=False, starting_values=None):
         """Create model, fit to `self.data`, and attach to `self.model` attribute.
         Parameters
         ----------
@@ -83,12 +151,152 @@ class GarchModel:
         q : ind
             Lag order of lagged volatility
 
+        warm_start : bool, optional
+            Whether to start the optimizer from the parameters of the latest
+            model of `self.ticker` with the same orders, if there is one.
+            By default, `False`.
+
+        starting_values : np.ndarray, None, optional
+            Parameters to start the optimizer from, takes precedence over
+            `warm_start`. By default, `None`.
+
         Returns
         -------
         None
         """
+        self.p = p
+        self.q = q
+
+        if starting_values is None and warm_start:
+            starting_values = self.previous_params(p=p, q=q)
+
         # Train Model, attach to `self.model`
-        self.model = arch_model(self.data, p=p, q=q, rescale=False).fit(disp=0)
+        start = time.perf_counter()
+        self.model = arch_model(self.data, p=p, q=q, rescale=False).fit(
+            disp=0, starting_values=starting_values
+        )
+        self.fit_seconds = time.perf_counter() - start
+        self.iterations = int(self.model.optimization_result.nit)
+
+    def select_order(
+        self, p_values, q_values, criterion="bic", executor=None, max_workers=None
+    ):
+        """Fit every combination of lag orders to `self.data` in parallel
+        worker processes, then fit the best one and attach it to
+        `self.model`.
+
+        The returns are written once to a temporary `.npy` file that all
+        workers memory-map, so they are neither re-read from the repository
+        nor pickled for each candidate.
+
+        Parameters
+        ----------
+        p_values : list
+            Candidate lag orders of the symmetric innovation.
+        q_values : list
+            Candidate lag orders of lagged volatility.
+        criterion : str, optional
+            Information criterion used to rank candidates, "aic" or "bic".
+            By default, "bic".
+        executor : concurrent.futures.Executor, None, optional
+            Executor that fits the candidates. If `None`, a
+            `ProcessPoolExecutor` is created for this selection. By default,
+            `None`.
+        max_workers : int, None, optional
+            Number of worker processes when `executor` is `None`. If `None`,
+            one per CPU core. By default, `None`.
+
+        Returns
+        -------
+        list
+            Result of `fit_candidate` for each combination, best first.
+            Candidates that failed to fit come last.
+        """
+        if criterion not in CRITERIA:
+            raise ValueError(f"Unknown information criterion '{criterion}'.")
+        p_values, q_values = list(p_values), list(q_values)
+        if not p_values or not q_values or min(p_values + q_values) < 1:
+            raise ValueError("Candidate orders need at least one p and one q, all at least 1.")
+        if executor is None:
+            with ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                return self.select_order(
+                    p_values, q_values, criterion=criterion, executor=executor
+                )
+
+        fd, returns_path = tempfile.mkstemp(suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, self.data.to_numpy(dtype=np.float64))
+            futures = [
+                executor.submit(fit_candidate, returns_path, p, q)
+                for p in p_values
+                for q in q_values
+            ]
+            candidates = [future.result() for future in futures]
+        finally:
+            os.remove(returns_path)
+
+        candidates.sort(
+            key=lambda c: (not c["success"], c[criterion] if c["success"] else 0)
+        )
+        best = candidates[0]
+        if not best["success"]:
+            raise Exception(f"No candidate order could be fit: {best['message']}")
+
+        # Refit best order here, from the parameters the worker found
+        self.fit(p=best["p"], q=best["q"], starting_values=np.array(best["params"]))
+
+        return candidates
+
+    def previous_params(self, p, q):
+        """Return parameters of the latest model of `self.ticker` if it has
+        orders `p` and `q`, otherwise `None`.
+
+        Returns
+        -------
+        np.ndarray, None
+            Values of 'mu', 'omega', 'alpha[1]'..., and 'beta[1]'....
+        """
+        record = self.registry.latest(self.ticker)
+        if record is None or record["params"] is None:
+            return None
+        if (record["p"], record["q"]) != (p, q):
+            return None
+
+        return np.array(json.loads(record["params"]))
+
+    def is_current(self, p, q, tolerance=0):
+        """Return whether the latest model of `self.ticker` can stand in for
+        refitting on `self.data`.
+
+        That is the case when it has the same orders and window length, and
+        `self.data` has at most `tolerance` observations after the end of
+        its training window.
+
+        Parameters
+        ----------
+        p : int
+        q : int
+        tolerance : int, optional
+            Number of new observations that don't require a refit. By
+            default, 0.
+
+        Returns
+        -------
+        bool
+        """
+        record = self.registry.latest(self.ticker)
+        if record is None or record["end_date"] is None:
+            return False
+        if (record["p"], record["q"], record["n_observations"]) != (
+            p, q, self.n_observations
+        ):
+            return False
+
+        new_observations = (self.data.index > pd.Timestamp(record["end_date"])).sum()
+        return new_observations <= tolerance
 
     def __clean_prediction(self, prediction):
         """Reformat model prediction to JSON.
@@ -136,6 +344,10 @@ class GarchModel:
             Forecast of volatility. Each key is date in ISO 8601 format.
             Each value is predicted volatility.
         """
+        # Compact models forecast with NumPy
+        if isinstance(self.model, CompactGarch):
+            return self.model.predict_volatility(horizon)
+
         # Generate variance forecast from `self.model`
         prediction = self.model.forecast(horizon=horizon, reindex=False).variance
 
@@ -145,35 +357,238 @@ class GarchModel:
         # Return `prediction_formatted`
         return prediction_formatted
 
-    def dump(self):
-        """Save model to `self.model_directory` with timestamp.
+    def dump(self, model_format=None):
+        """Save model to `self.model_directory` with timestamp and record it
+        in `self.registry`. Models of `self.ticker` older than the
+        `settings.model_retention` most recent ones are deleted.
+
+        Parameters
+        ----------
+        model_format : str, None, optional
+            "pickle" saves the whole `arch` result with joblib. "compact"
+            saves a `CompactGarch` JSON artifact with only the parameters
+            needed for forecasting. By default, `settings.model_format`.
 
         Returns
         -------
         str
             filepath where model was saved.
         """
+        if model_format is None:
+            model_format = settings.model_format
+        if model_format not in ("pickle", "compact"):
+            raise ValueError(f"Unknown model format '{model_format}'.")
         # Create timestamp in ISO format
         timestamp = pd.Timestamp.now().isoformat()
         # Create filepath, including `self.model_directory`
-        filepath = os.path.join(self.model_directory, f"{timestamp}_{self.ticker}.pkl")
+        extension = "json" if model_format == "compact" else "pkl"
+        filepath = os.path.join(
+            self.model_directory, f"{timestamp}_{self.ticker}.{extension}"
+        )
         # Save `self.model`
-        joblib.dump(self.model, filepath)
+        if model_format == "compact":
+            model = self.model
+            if not isinstance(model, CompactGarch):
+                model = CompactGarch.from_result(model)
+            model.save(filepath)
+        else:
+            joblib.dump(self.model, filepath)
+        self.version = os.path.basename(filepath)
+        # Record model in registry, remove superseded ones
+        self.registry.register(
+            ticker=self.ticker,
+            path=filepath,
+            p=self.p,
+            q=self.q,
+            n_observations=self.n_observations,
+            start_date=self.data.index[0],
+            end_date=self.data.index[-1],
+            fitted_at=timestamp,
+            params=self.__params(),
+            iterations=self.iterations,
+            fit_seconds=self.fit_seconds,
+        )
+        self.registry.collect_garbage(
+            ticker=self.ticker, keep=settings.model_retention
+        )
         # Return filepath
         return filepath
 
+    def __params(self):
+        """Return parameter values of `self.model` in `arch` order."""
+        if isinstance(self.model, CompactGarch):
+            return [self.model.mu, self.model.omega, *self.model.alpha, *self.model.beta]
+        return self.model.params.tolist()
+
     def load(self):
-        """Load most recent model in `self.model_directory` for `self.ticker`,
-        attach to `self.model` attribute.
+        """Load most recent model for `self.ticker` recorded in
+        `self.registry`, attach to `self.model` attribute.
 
         """
-        # Create pattern for glob search
-        pattern = os.path.join(self.model_directory, f"*{self.ticker}.pkl")
-        # Use glob to get most recent model, handle errors
-        try:
-            model_path = sorted(glob(pattern))[-1]
-
-        except IndexError:
+        # Look up most recent model, handle errors
+        record = self.registry.latest(self.ticker)
+        if record is None:
             raise Exception(f"No model trained for '{self.ticker}'.")
+        # Read model file, check it is the one that was recorded
+        with open(record["path"], "rb") as f:
+            content = f.read()
+        if record["checksum"] != hashlib.sha256(content).hexdigest():
+            raise Exception(f"Model file '{record['path']}' is corrupted.")
         # Load model and attach to `self.model`
-        self.model = joblib.load(model_path)
+        if record["path"].endswith(".json"):
+            self.model = CompactGarch.from_dict(json.loads(content))
+        else:
+            self.model = joblib.load(io.BytesIO(content))
+        self.version = os.path.basename(record["path"])
+
+    @staticmethod
+    def fit_batch(jobs, executor=None, max_workers=None):
+        """Train and save models for several tickers in parallel worker
+        processes.
+
+        Parameters
+        ----------
+        jobs : list
+            Each item is a dictionary with keys 'ticker', 'use_new_data',
+            'n_observations', 'p', and 'q'.
+        executor : concurrent.futures.Executor, None, optional
+            Executor that runs the jobs. If `None`, a `ProcessPoolExecutor`
+            is created for this batch. By default, `None`.
+        max_workers : int, None, optional
+            Number of worker processes when `executor` is `None`. If `None`,
+            one per CPU core. By default, `None`.
+
+        Returns
+        -------
+        list
+            Result of `fit_ticker` for each job, in the order of `jobs`.
+        """
+        if executor is None:
+            with ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                return GarchModel.fit_batch(jobs, executor=executor)
+
+        futures = [executor.submit(fit_ticker, **job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def version_timestamp(version):
+    """Return time a model version was saved, versions are file names
+    written by `GarchModel.dump`."""
+    return pd.Timestamp(version.split("_", 1)[0])
+
+
+def fit_candidate(returns_path, p, q):
+    """Fit GARCH(`p`, `q`) model to the returns stored at `returns_path`.
+
+    Runs in a worker process of `GarchModel.select_order`. Errors are
+    reported in the result instead of being raised.
+
+    Parameters
+    ----------
+    returns_path : str
+        Path of `.npy` file with the returns, memory-mapped read-only.
+    p : int
+    q : int
+
+    Returns
+    -------
+    dict
+        Keys are 'p', 'q', 'success', 'message', 'aic', 'bic',
+        'loglikelihood', 'params', 'iterations', and 'fit_seconds'.
+    """
+    result = {
+        "p": p,
+        "q": q,
+        "success": False,
+        "message": "",
+        "aic": None,
+        "bic": None,
+        "loglikelihood": None,
+        "params": None,
+        "iterations": None,
+        "fit_seconds": 0.0,
+    }
+    start = time.perf_counter()
+    try:
+        returns = np.load(returns_path, mmap_mode="r")
+        fitted = arch_model(returns, p=p, q=q, rescale=False).fit(disp=0)
+        result.update(
+            success=True,
+            aic=float(fitted.aic),
+            bic=float(fitted.bic),
+            loglikelihood=float(fitted.loglikelihood),
+            params=fitted.params.tolist(),
+            iterations=int(fitted.optimization_result.nit),
+        )
+    except Exception as e:
+        result["message"] = str(e)
+    result["fit_seconds"] = time.perf_counter() - start
+
+    return result
+
+
+def fit_ticker(ticker, use_new_data, n_observations, p, q):
+    """Wrangle data, fit and save model for `ticker`.
+
+    Opens its own database connection so that it can run in a worker
+    process. Errors are reported in the result instead of being raised.
+
+    Parameters
+    ----------
+    ticker : str
+    use_new_data : bool
+    n_observations : int
+    p : int
+    q : int
+
+    Returns
+    -------
+    dict
+        Keys are 'ticker', 'success', 'message', the timings in seconds
+        'wrangle_seconds', 'fit_seconds', 'dump_seconds', and 'seconds', and
+        'iterations' of the optimizer, `None` if the refit was skipped.
+    """
+    result = {
+        "ticker": ticker,
+        "success": False,
+        "message": "",
+        "wrangle_seconds": 0.0,
+        "fit_seconds": 0.0,
+        "dump_seconds": 0.0,
+        "seconds": 0.0,
+        "iterations": None,
+    }
+    start = time.perf_counter()
+    connection = sqlite3.connect(settings.db_name, timeout=30)
+    try:
+        repo = get_repository(connection=connection)
+        model = GarchModel(ticker=ticker, repo=repo, use_new_data=use_new_data)
+        model.wrangle_data(n_observations=n_observations)
+        checkpoint = time.perf_counter()
+        result["wrangle_seconds"] = checkpoint - start
+
+        # Keep latest model if the window barely moved since it was trained
+        if model.is_current(p=p, q=q, tolerance=settings.refit_tolerance):
+            file_name = model.registry.latest(ticker)["path"]
+            result["success"] = True
+            result["message"] = f"'{file_name}' is current, skipped refit."
+            return result
+
+        model.fit(p=p, q=q, warm_start=settings.warm_start)
+        result["fit_seconds"] = time.perf_counter() - checkpoint
+        result["iterations"] = model.iterations
+        checkpoint = time.perf_counter()
+
+        file_name = model.dump()
+        result["dump_seconds"] = time.perf_counter() - checkpoint
+        result["success"] = True
+        result["message"] = f"Trained and saved '{file_name}'."
+    except Exception as e:
+        result["message"] = str(e)
+    finally:
+        connection.close()
+        result["seconds"] = time.perf_counter() - start
+
+    return result
@@ -0,0 +1,34 @@
+"""Maintenance command that recomputes the ledger totals and rollup tables of
+user databases from their transactions, e.g. after editing a database by
+hand.
+
+Run from the repository root:
+
+    python rebuild_rollups.py [username ...]
+
+Without usernames, the databases of all users in `users.db` are rebuilt.
+"""
+
+import argparse
+
+from user import create_database, rebuild_rollups, unit_of_work
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("usernames", nargs="*", help="users to rebuild, all by default")
+    args = parser.parse_args()
+
+    usernames = args.usernames
+    if not usernames:
+        with unit_of_work() as conn:
+            usernames = [row[0] for row in conn.execute("SELECT username FROM users")]
+
+    for username in usernames:
+        # Make sure the rollup tables and triggers exist first
+        create_database(username)
+        rebuild_rollups(username)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""This module keeps an index of the trained models saved by `GarchModel`
+in a small SQLite database next to the model files, so that the latest
+model for a ticker can be found without scanning `model_directory`.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from glob import glob
+
+import pandas as pd
+
+REGISTRY_FILENAME = "registry.db"
+
+# Columns of the `models` table, in order
+FIELDS = [
+    "id",
+    "ticker",
+    "p",
+    "q",
+    "n_observations",
+    "start_date",
+    "end_date",
+    "fitted_at",
+    "path",
+    "checksum",
+    "params",
+    "iterations",
+    "fit_seconds",
+]
+
+# Columns added after the first release, with their types
+ADDED_COLUMNS = {"params": "TEXT", "iterations": "INTEGER", "fit_seconds": "REAL"}
+
+
+def file_checksum(filepath):
+    """Return SHA-256 hex digest of file at `filepath`."""
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ModelRegistry:
+    """Index of trained models stored in `model_directory`.
+
+    Parameters
+    ----------
+    model_directory : str
+        Directory where trained models are saved. The registry database is
+        created inside it.
+
+    Methods
+    -------
+    register
+        Record a newly saved model.
+    latest
+        Get the most recent model for a ticker.
+    list
+        Get all recorded models, optionally for one ticker.
+    collect_garbage
+        Delete superseded model files.
+    """
+
+    def __init__(self, model_directory):
+        self.model_directory = model_directory
+        self.__lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(model_directory, REGISTRY_FILENAME),
+            check_same_thread=False,
+            timeout=30,
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+
+        is_new = self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='models'"
+        ).fetchone() is None
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS models (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ticker TEXT NOT NULL,
+                    p INTEGER,
+                    q INTEGER,
+                    n_observations INTEGER,
+                    start_date TEXT,
+                    end_date TEXT,
+                    fitted_at TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    checksum TEXT,
+                    params TEXT,
+                    iterations INTEGER,
+                    fit_seconds REAL
+                )
+                """
+            )
+            # Upgrade registries created before these columns existed
+            info = self.connection.execute("PRAGMA table_info(models)")
+            columns = {row[1] for row in info}
+            for column, column_type in ADDED_COLUMNS.items():
+                if column not in columns:
+                    self.connection.execute(
+                        f"ALTER TABLE models ADD COLUMN {column} {column_type}"
+                    )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_models_ticker_id ON models (ticker, id)"
+            )
+
+        # Adopt models saved before the registry existed, only done once
+        if is_new:
+            self.__import_directory()
+
+    def __import_directory(self):
+        """Register `{timestamp}_{ticker}.pkl` files already in
+        `self.model_directory`, oldest first."""
+        for filepath in sorted(glob(os.path.join(self.model_directory, "*_*.pkl"))):
+            timestamp, ticker = os.path.basename(filepath)[:-4].split("_", 1)
+            self.register(
+                ticker=ticker, path=filepath, fitted_at=timestamp
+            )
+
+    def register(
+        self,
+        ticker,
+        path,
+        p=None,
+        q=None,
+        n_observations=None,
+        start_date=None,
+        end_date=None,
+        fitted_at=None,
+        params=None,
+        iterations=None,
+        fit_seconds=None,
+    ):
+        """Record a saved model.
+
+        Parameters
+        ----------
+        ticker : str
+            Ticker symbol the model was trained for.
+        path : str
+            Path of the model file.
+        p : int, None, optional
+            Lag order of the symmetric innovation.
+        q : int, None, optional
+            Lag order of lagged volatility.
+        n_observations : int, None, optional
+            Number of observations requested for training.
+        start_date : str, pd.Timestamp, None, optional
+            First date of the training window.
+        end_date : str, pd.Timestamp, None, optional
+            Last date of the training window.
+        fitted_at : str, None, optional
+            Time the model was trained in ISO 8601 format. By default, now.
+        params : list, None, optional
+            Fitted parameter values, used as starting values of a refit.
+        iterations : int, None, optional
+            Number of optimizer iterations of the fit.
+        fit_seconds : float, None, optional
+            Duration of the fit.
+
+        Returns
+        -------
+        dict
+            The registry record, keys are `FIELDS`.
+        """
+        if fitted_at is None:
+            fitted_at = pd.Timestamp.now().isoformat()
+        if start_date is not None:
+            start_date = pd.Timestamp(start_date).date().isoformat()
+        if end_date is not None:
+            end_date = pd.Timestamp(end_date).date().isoformat()
+
+        record = {
+            "ticker": ticker,
+            "p": p,
+            "q": q,
+            "n_observations": n_observations,
+            "start_date": start_date,
+            "end_date": end_date,
+            "fitted_at": fitted_at,
+            "path": path,
+            "checksum": file_checksum(path),
+            "params": json.dumps(list(params)) if params is not None else None,
+            "iterations": iterations,
+            "fit_seconds": fit_seconds,
+        }
+        columns = ", ".join(record)
+        placeholders = ", ".join("?" * len(record))
+        with self.__lock, self.connection:
+            cursor = self.connection.execute(
+                f"INSERT INTO models ({columns}) VALUES ({placeholders})",
+                tuple(record.values()),
+            )
+        record["id"] = cursor.lastrowid
+
+        return {field: record[field] for field in FIELDS}
+
+    def latest(self, ticker):
+        """Return most recent record for `ticker`, `None` if there is none."""
+        with self.__lock:
+            row = self.connection.execute(
+                "SELECT * FROM models WHERE ticker = ? ORDER BY id DESC LIMIT 1",
+                (ticker,),
+            ).fetchone()
+
+        return dict(row) if row is not None else None
+
+    def list(self, ticker=None):
+        """Return records for `ticker`, or for all tickers if `None`, most
+        recent first."""
+        sql = "SELECT * FROM models"
+        params = ()
+        if ticker is not None:
+            sql += " WHERE ticker = ?"
+            params = (ticker,)
+        sql += " ORDER BY id DESC"
+        with self.__lock:
+            rows = self.connection.execute(sql, params).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def collect_garbage(self, ticker=None, keep=1):
+        """Delete superseded models, keeping the `keep` most recent ones.
+
+        Parameters
+        ----------
+        ticker : str, None, optional
+            Ticker whose models are collected. If `None`, models of all
+            tickers are collected. By default, `None`.
+        keep : int, optional
+            Number of most recent models kept per ticker. By default, 1.
+
+        Returns
+        -------
+        list
+            Paths of the deleted model files.
+        """
+        sql = """
+            SELECT id, path FROM (
+                SELECT id, path, ROW_NUMBER() OVER (
+                    PARTITION BY ticker ORDER BY id DESC
+                ) AS rank
+                FROM models {where}
+            )
+            WHERE rank > ?
+        """
+        where, params = "", (keep,)
+        if ticker is not None:
+            where, params = "WHERE ticker = ?", (ticker, keep)
+
+        with self.__lock, self.connection:
+            rows = self.connection.execute(sql.format(where=where), params).fetchall()
+            self.connection.executemany(
+                "DELETE FROM models WHERE id = ?", [(row["id"],) for row in rows]
+            )
+
+        deleted = []
+        for row in rows:
+            try:
+                os.remove(row["path"])
+            except FileNotFoundError:
+                continue
+            deleted.append(row["path"])
+
+        return deleted
+
+
+# One registry per model directory and process
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(model_directory):
+    """Return shared `ModelRegistry` for `model_directory`, opening it on
+    first use. Forked worker processes get their own connection."""
+    key = (os.getpid(), model_directory)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(model_directory)
+        return _registries[key]
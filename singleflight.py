@@ -0,0 +1,86 @@
+"""This module coalesces concurrent identical calls, so that a burst of
+requests for the same work only does it once and shares the result.
+"""
+
+import threading
+
+
+class _Call:
+    """In-flight call shared by all callers with the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time. Callers that arrive while a
+    call with their key is running wait for it and get its result, or its
+    exception.
+
+    Attributes
+    ----------
+    calls : int
+        Number of calls that did the work.
+    shared : int
+        Number of callers that received the result of another call.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self.__lock = threading.Lock()
+        self.__in_flight = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """Return `function(*args, **kwargs)`, or the result of the call with
+        the same `key` that is already running.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies calls that are interchangeable.
+        function : callable
+
+        Returns
+        -------
+        object
+            Return value of the call.
+        """
+        with self.__lock:
+            call = self.__in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.__in_flight[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        """Return counters as a dictionary."""
+        with self.__lock:
+            return {
+                "in_flight": len(self.__in_flight),
+                "calls": self.calls,
+                "shared": self.shared,
+            }
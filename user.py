@@ -1,14 +1,133 @@
 import sqlite3
 import datetime
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import bcrypt
 
+# Database with the accounts of all users
+USERS_DB = "users.db"
+
+# Version of the user database schema, stored in `PRAGMA user_version`
+SCHEMA_VERSION = 1
+
+# Condition of the ledger and rollup triggers, false while they are deferred
+NOT_DEFERRED = "(SELECT deferred FROM ledger WHERE id = 1) = 0"
+
+# Users whose aggregates this process is deferring, see `deferred_aggregates`
+_deferring = set()
+
+
+class ConnectionCache:
+    """
+    Keeps connections to user databases open between calls, so a page load
+    connects to each database once instead of once per query. Pragmas are
+    applied when a connection is opened. At most `max_open` connections stay
+    open, the least recently used idle one is closed to make room.
+
+    Connections are in autocommit mode, transactions are started by
+    `unit_of_work`.
+
+    :param max_open: Maximum number of idle connections kept open.
+    :param cache_size: Value of `PRAGMA cache_size` for every connection.
+    """
+
+    def __init__(self, max_open=32, cache_size=-8192):
+        self.max_open = max_open
+        self.cache_size = cache_size
+        self.__lock = threading.Lock()
+        # db_name -> [connection, lock, users], least recently used first
+        self.__entries = OrderedDict()
+
+    def __open(self, db_name):
+        conn = sqlite3.connect(db_name, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        return conn
+
+    def acquire(self, db_name):
+        """
+        Returns the cached connection to `db_name` and the lock that serializes
+        its use, opening it if needed. Must be paired with `release`.
+        """
+        with self.__lock:
+            entry = self.__entries.get(db_name)
+            if entry is None:
+                entry = self.__entries[db_name] = [self.__open(db_name), threading.RLock(), 0]
+            self.__entries.move_to_end(db_name)
+            entry[2] += 1
+
+            # Close least recently used connections nobody is using
+            for name, (conn, lock, users) in list(self.__entries.items()):
+                if len(self.__entries) <= self.max_open:
+                    break
+                if users == 0:
+                    conn.close()
+                    del self.__entries[name]
+
+            return entry[0], entry[1]
+
+    def release(self, db_name):
+        """Marks a connection returned by `acquire` as no longer used by the caller."""
+        with self.__lock:
+            self.__entries[db_name][2] -= 1
+
+    def close(self):
+        """Closes all idle connections."""
+        with self.__lock:
+            for name, (conn, lock, users) in list(self.__entries.items()):
+                if users == 0:
+                    conn.close()
+                    del self.__entries[name]
+
+    @contextmanager
+    def unit_of_work(self, db_name):
+        """
+        Runs the enclosed statements in one transaction on the cached connection
+        to `db_name`, so reads share a snapshot and writes commit together. The
+        transaction is committed on exit and rolled back on error. Nested units
+        of work on the same database in the same thread join the outer one.
+
+        :param db_name: Path of the database.
+        :return: The connection.
+        """
+        conn, lock = self.acquire(db_name)
+        try:
+            with lock:
+                if conn.in_transaction:
+                    yield conn
+                    return
+                conn.execute("BEGIN")
+                try:
+                    yield conn
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+        finally:
+            self.release(db_name)
+
+
+connections = ConnectionCache()
+
+
+def unit_of_work(username=None):
+    """
+    Opens a unit of work on the database of `username`, see `ConnectionCache.unit_of_work`.
+
+    :param username: The username of the user, the users database if None.
+    """
+    return connections.unit_of_work(f"{username}.db" if username else USERS_DB)
+
 # Function to authenticate user
 def authenticate(username, password):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT password FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
+    with unit_of_work() as conn:
+        c = conn.cursor()
+        c.execute("SELECT password FROM users WHERE username = ?", (username,))
+        result = c.fetchone()
 
     if result and bcrypt.checkpw(password.encode('utf-8'), result[0]):
         return True
@@ -17,57 +136,230 @@ def authenticate(username, password):
 
 # Function to create a new user
 def create_user(username, password):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
     if password is None:
         raise ValueError("Password cannot be None")
 
-    c.execute("SELECT username FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    if result:
-        raise ValueError("Username already exists")
+    with unit_of_work() as conn:
+        c = conn.cursor()
+        c.execute("SELECT username FROM users WHERE username = ?", (username,))
+        result = c.fetchone()
+        if result:
+            raise ValueError("Username already exists")
 
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-    conn.commit()
-    conn.close()
+        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
 
 # Function to create a database for a user
 def create_database(username):
-    db_name = f"{username}.db"
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
+    with unit_of_work(username) as conn:
+        c = conn.cursor()
 
-    # create the income table
-    c.execute("CREATE TABLE IF NOT EXISTS income (id INTEGER PRIMARY KEY, amount REAL, date TEXT)")
+        # create the income table
+        c.execute("CREATE TABLE IF NOT EXISTS income (id INTEGER PRIMARY KEY, amount REAL, date TEXT)")
 
-    # create the expenses table
-    c.execute('''CREATE TABLE IF NOT EXISTS expenses
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, amount REAL, category TEXT, date TEXT)''')
+        # create the expenses table
+        c.execute('''CREATE TABLE IF NOT EXISTS expenses
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, amount REAL, category TEXT, date TEXT)''')
+
+        # Create the savings table
+        c.execute("CREATE TABLE IF NOT EXISTS savings (id INTEGER PRIMARY KEY AUTOINCREMENT, amount REAL, date TEXT)")
+
+        # Recreate triggers written by earlier versions of this module
+        c.execute("PRAGMA user_version")
+        if c.fetchone()[0] < SCHEMA_VERSION:
+            c.execute("SELECT name FROM sqlite_master WHERE type='trigger'")
+            for (trigger,) in c.fetchall():
+                c.execute(f"DROP TRIGGER {trigger}")
+
+        # Create the ledger with running totals, kept current by triggers
+        create_ledger(c)
+
+        # Create the monthly and daily rollups, kept current by triggers
+        create_rollups(c)
+
+        # Resume triggers left paused by an import that didn't finish, the
+        # aggregates missed its writes
+        c.execute("SELECT deferred FROM ledger WHERE id = 1")
+        if c.fetchone()[0] and username not in _deferring:
+            c.execute("UPDATE ledger SET deferred = 0 WHERE id = 1")
+            refresh_aggregates(c)
+            record_savings(c)
+
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def create_ledger(c) -> None:
+    """
+    Creates the single-row ledger table holding the running income and expense
+    totals of a user database, and the triggers that apply every insert, update
+    and delete of income and expenses to it as a delta. Databases created before
+    the ledger existed are seeded from their current totals once.
+
+    :param c: Cursor of the user database.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS ledger
+                 (id INTEGER PRIMARY KEY CHECK (id = 1),
+                  income REAL NOT NULL DEFAULT 0,
+                  expenses REAL NOT NULL DEFAULT 0,
+                  deferred INTEGER NOT NULL DEFAULT 0)""")
+    c.execute("PRAGMA table_info(ledger)")
+    if "deferred" not in {row[1] for row in c.fetchall()}:
+        c.execute("ALTER TABLE ledger ADD COLUMN deferred INTEGER NOT NULL DEFAULT 0")
+    c.execute("""INSERT OR IGNORE INTO ledger (id, income, expenses)
+                 VALUES (1, (SELECT COALESCE(SUM(amount), 0) FROM income),
+                            (SELECT COALESCE(SUM(amount), 0) FROM expenses))""")
+
+    for table, column in (("income", "income"), ("expenses", "expenses")):
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_ledger_insert AFTER INSERT ON {table}
+                      WHEN {NOT_DEFERRED}
+                      BEGIN
+                          UPDATE ledger SET {column} = {column} + COALESCE(NEW.amount, 0) WHERE id = 1;
+                      END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_ledger_update AFTER UPDATE OF amount ON {table}
+                      WHEN {NOT_DEFERRED}
+                      BEGIN
+                          UPDATE ledger SET {column} = {column} - COALESCE(OLD.amount, 0) + COALESCE(NEW.amount, 0)
+                          WHERE id = 1;
+                      END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_ledger_delete AFTER DELETE ON {table}
+                      WHEN {NOT_DEFERRED}
+                      BEGIN
+                          UPDATE ledger SET {column} = {column} - COALESCE(OLD.amount, 0) WHERE id = 1;
+                      END""")
+
+
+# Rollup tables of a user database: name -> (source table, key columns, key expressions)
+ROLLUPS = {
+    "expense_rollup": ("expenses", ("month", "category"), ("strftime('%Y-%m', {row}.date)", "COALESCE({row}.category, '')")),
+    "expense_daily": ("expenses", ("day",), ("date({row}.date)",)),
+    "income_monthly": ("income", ("month",), ("strftime('%Y-%m', {row}.date)",)),
+}
+
+
+def create_rollups(c) -> None:
+    """
+    Creates the rollup tables of a user database, holding the sum and count of
+    expenses per (month, category) and per day, and of income per month, and the
+    triggers that apply every insert, update and delete to them. Rows whose count
+    drops to zero are removed. Databases created before the rollups existed are
+    filled from their current transactions once.
+
+    :param c: Cursor of the user database.
+    """
+    for rollup, (table, keys, expressions) in ROLLUPS.items():
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (rollup,))
+        is_new = c.fetchone() is None
+
+        key_columns = ", ".join(f"{key} TEXT NOT NULL" for key in keys)
+        c.execute(f"""CREATE TABLE IF NOT EXISTS {rollup}
+                      ({key_columns}, total REAL NOT NULL, count INTEGER NOT NULL,
+                       PRIMARY KEY ({", ".join(keys)})) WITHOUT ROWID""")
+
+        new_keys = [expression.format(row="NEW") for expression in expressions]
+        old_keys = [expression.format(row="OLD") for expression in expressions]
+        old_match = " AND ".join(f"{key} = {expression}" for key, expression in zip(keys, old_keys))
+        add_new = f"""INSERT INTO {rollup} ({", ".join(keys)}, total, count)
+                      SELECT {", ".join(new_keys)}, COALESCE(NEW.amount, 0), 1
+                      WHERE {" AND ".join(f"{key} IS NOT NULL" for key in new_keys)}
+                      ON CONFLICT ({", ".join(keys)})
+                      DO UPDATE SET total = total + excluded.total, count = count + 1;"""
+        remove_old = f"""UPDATE {rollup} SET total = total - COALESCE(OLD.amount, 0), count = count - 1
+                         WHERE {old_match};
+                         DELETE FROM {rollup} WHERE {old_match} AND count <= 0;"""
+
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {rollup}_insert AFTER INSERT ON {table}
+                      WHEN {NOT_DEFERRED} BEGIN {add_new} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {rollup}_update AFTER UPDATE ON {table}
+                      WHEN {NOT_DEFERRED} BEGIN {remove_old} {add_new} END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {rollup}_delete AFTER DELETE ON {table}
+                      WHEN {NOT_DEFERRED} BEGIN {remove_old} END""")
+
+        if is_new:
+            refresh_rollup(c, rollup)
+
+
+def refresh_rollup(c, rollup) -> None:
+    """
+    Recomputes a rollup table from its source table.
+
+    :param c: Cursor of the user database.
+    :param rollup: Name of the rollup table, a key of `ROLLUPS`.
+    """
+    table, keys, expressions = ROLLUPS[rollup]
+    key_expressions = [expression.format(row=table) for expression in expressions]
+    c.execute(f"DELETE FROM {rollup}")
+    c.execute(f"""INSERT INTO {rollup} ({", ".join(keys)}, total, count)
+                  SELECT {", ".join(key_expressions)}, SUM(COALESCE(amount, 0)), COUNT(*) FROM {table}
+                  WHERE {" AND ".join(f"{expression} IS NOT NULL" for expression in key_expressions)}
+                  GROUP BY {", ".join(str(i + 1) for i in range(len(keys)))}""")
+
+
+def rebuild_rollups(username) -> None:
+    """
+    Recomputes the ledger totals and all rollup tables of a user from scratch, in
+    one transaction.
+
+    :param username: The username of the user.
+    """
+    with unit_of_work(username) as conn:
+        refresh_aggregates(conn.cursor())
+
+    print(f"Rebuilt rollups of {username}.")
+
+
+def refresh_aggregates(c) -> None:
+    """
+    Recomputes the ledger totals and all rollup tables from the transactions.
+
+    :param c: Cursor of the user database.
+    """
+    c.execute("""UPDATE ledger SET income = (SELECT COALESCE(SUM(amount), 0) FROM income),
+                                   expenses = (SELECT COALESCE(SUM(amount), 0) FROM expenses)
+                 WHERE id = 1""")
+    for rollup in ROLLUPS:
+        refresh_rollup(c, rollup)
+
+
+@contextmanager
+def deferred_aggregates(username):
+    """
+    Pauses the ledger and rollup triggers of a user database while the enclosed
+    block writes transactions, e.g. across the chunks of a bulk import, then
+    recomputes the aggregates once and records a savings snapshot. The
+    aggregates are recomputed even if the block fails. If the process dies
+    first, the pause stays in the database until `create_database` finds it.
+
+    :param username: The username of the user.
+    """
+    _deferring.add(username)
+    try:
+        with unit_of_work(username) as conn:
+            conn.execute("UPDATE ledger SET deferred = 1 WHERE id = 1")
+        try:
+            yield
+        finally:
+            with unit_of_work(username) as conn:
+                c = conn.cursor()
+                c.execute("UPDATE ledger SET deferred = 0 WHERE id = 1")
+                refresh_aggregates(c)
+                record_savings(c)
+    finally:
+        _deferring.discard(username)
 
-    # Create the savings table
-    c.execute("CREATE TABLE IF NOT EXISTS savings (id INTEGER PRIMARY KEY AUTOINCREMENT, amount REAL, date TEXT)")
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
 
 def add_interests(username, interests):
     # Convert the list of interests to a comma-separated string
     interests_str = ', '.join(interests)
 
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("UPDATE users SET interests=? WHERE username=?", (interests_str, username))
-    conn.commit()
-    conn.close()
+    with unit_of_work() as conn:
+        conn.execute("UPDATE users SET interests=? WHERE username=?", (interests_str, username))
     print("Interests added successfully.")
 
 def get_interests(username):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    c.execute("SELECT interests FROM users WHERE username=?", (username,))
-    result = c.fetchone()
-    conn.close()
+    with unit_of_work() as conn:
+        c = conn.cursor()
+        c.execute("SELECT interests FROM users WHERE username=?", (username,))
+        result = c.fetchone()
 
     if result:
         interests_str = result[0]
@@ -78,19 +370,16 @@ def get_interests(username):
 
 def add_income(username, amount, date):
     if username:
-        db_name = f"{username}.db"
-        conn = sqlite3.connect(db_name)
-        c = conn.cursor()
-
         # Calculate the month from the date
         dt = datetime.datetime.strptime(date, "%Y-%m-%d")
         month = dt.month
 
-        # Insert the income into the income table
-        c.execute("INSERT INTO income (amount, date) VALUES (?, ?)", (amount, date))
+        with unit_of_work(username) as conn:
+            c = conn.cursor()
 
-        conn.commit()
-        conn.close()
+            # Insert the income into the income table, record the new savings
+            c.execute("INSERT INTO income (amount, date) VALUES (?, ?)", (amount, date))
+            record_savings(c, date)
 
         print("Income added successfully.")
 
@@ -108,11 +397,11 @@ def update_income(username: str, income_id: int, amount: float, date: object) ->
     :param amount: The new amount of the income.
     :param month: The new month of the income.
     """
-    with sqlite3.connect(f"{username}.db") as conn:
+    with unit_of_work(username) as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE income SET amount=?, date=? WHERE id=?", (amount, date, income_id))
+        record_savings(cursor, date)
         print(f"Updated income successfully with id: {income_id}.")
-        conn.commit()
 
 
 def delete_income(username: str, income_id: int) -> None:
@@ -122,35 +411,31 @@ def delete_income(username: str, income_id: int) -> None:
     :param username: The username of the user.
     :param income_id: The ID of the income record to delete.
     """
-    with sqlite3.connect(f"{username}.db") as conn:
+    with unit_of_work(username) as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM income WHERE id=?", (income_id,))
+        record_savings(cursor)
         print(f"Deleted income with id: {income_id}.")
-        conn.commit()
 
 # Helper function to get income data from the database
 def get_income(username):
-    db_name = f"{username}.db"
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-    c.execute("SELECT id, amount, date FROM income ORDER BY date DESC")
-    income_data = c.fetchall()
-    conn.close()
+    with unit_of_work(username) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, amount, date FROM income ORDER BY date DESC")
+        income_data = c.fetchall()
     return income_data
 
 # Function to add an expense for a user
 def add_expense(username, amount, category, date):
-    db_name = f"{username}.db"
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
     try:
-        c.execute("INSERT INTO expenses (amount, category, date) VALUES (?, ?, ?)", (amount, category, date))
-        conn.commit()
-        calculate_savings(username)
+        # Insert the expense and record the new savings in one transaction
+        with unit_of_work(username) as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO expenses (amount, category, date) VALUES (?, ?, ?)", (amount, category, date))
+            record_savings(c, date)
+        print("Savings calculated successfully.")
     except sqlite3.Error as e:
-        conn.close()
         raise sqlite3.Error("Failed to add expense: " + str(e))
-    conn.close()
 
 def update_expense(username: str, expense_id: int, amount: float, category: str, date: str) -> None:
     """
@@ -162,11 +447,11 @@ def update_expense(username: str, expense_id: int, amount: float, category: str,
     :param category: The new category of the expense.
     :param date: The new date of the expense in 'YYYY-MM-DD' format.
     """
-    with sqlite3.connect(f"{username}.db") as conn:
+    with unit_of_work(username) as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE expenses SET amount=?, category=?, date=? WHERE id=?", (amount, category, date, expense_id))
+        record_savings(cursor, date)
         print(f"Updated expense successfully with id: {expense_id}.")
-        conn.commit()
 
 
 def delete_expense(username: str, expense_id: int) -> None:
@@ -176,69 +461,53 @@ def delete_expense(username: str, expense_id: int) -> None:
     :param username: The username of the user.
     :param expense_id: The ID of the expense record to delete.
     """
-    with sqlite3.connect(f"{username}.db") as conn:
+    with unit_of_work(username) as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM expenses WHERE id=?", (expense_id,))
+        record_savings(cursor)
         print(f"Deleted expense with id: {expense_id}.")
-        conn.commit()
 
 # Function to get all expenses for a user
 def get_all_expenses(username):
-    db_name = f"{username}.db"
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-
-    c.execute("SELECT * FROM expenses")
-    all_expenses = c.fetchall()
-
-    conn.close()
+    with unit_of_work(username) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM expenses")
+        all_expenses = c.fetchall()
 
     return all_expenses
 
 # Function to get all savings for a user
 def get_all_savings(username):
-    db_name = f"{username}.db"
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-
-    c.execute("SELECT * FROM savings")
-    all_savings = c.fetchall()
-
-    conn.close()
+    with unit_of_work(username) as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM savings")
+        all_savings = c.fetchall()
 
     return all_savings
 
-# Function to calculate savings for a user
-def calculate_savings(username):
-    db_name = f"{username}.db"
-    conn = sqlite3.connect(db_name)
-    c = conn.cursor()
-
-    # Get the income for the user
-    c.execute("SELECT SUM(amount) FROM income")
-    income = c.fetchone()[0]
-    if income is None:
-        income = 0
-
-    # Get the total expenses for the user
-    c.execute("SELECT amount, date FROM expenses")
-    expense_data = c.fetchall()
-
-    total_expenses = 0
-    for amount, added_date in expense_data:
-        total_expenses += amount
+def record_savings(c, date=None) -> float:
+    """
+    Appends a savings snapshot derived from the ledger totals, without scanning
+    the income and expenses tables.
 
-    if total_expenses is None:
-        total_expenses = 0
+    :param c: Cursor of the user database, the snapshot joins its transaction.
+    :param date: Date of the snapshot in 'YYYY-MM-DD' format, today if None.
+    :return: The savings, total income minus total expenses.
+    """
+    if date is None:
+        date = datetime.date.today().isoformat()
 
-    # Calculate the savings for the user
-    savings = income - total_expenses
+    c.execute("SELECT income - expenses FROM ledger WHERE id = 1")
+    savings = c.fetchone()[0]
+    c.execute("INSERT INTO savings (amount, date) VALUES (?, ?)", (savings, date))
 
-    # Insert the savings into the savings table
-    c.execute("INSERT INTO savings (amount, date) VALUES (?, ?)", (savings, added_date))
+    return savings
 
-    conn.commit()
-    conn.close()
+# Function to calculate savings for a user
+def calculate_savings(username, date=None):
+    # Read the running totals from the ledger and insert the savings
+    with unit_of_work(username) as conn:
+        savings = record_savings(conn.cursor(), date)
 
     print("Savings calculated successfully.")
 